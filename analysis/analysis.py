@@ -2,8 +2,10 @@ from time import sleep
 
 import numpy as np
 import array
+import itertools
 
 from common.basic import *
+from common import cache
 
 # Time:price class
 class Data(object):
@@ -20,17 +22,71 @@ class Data(object):
 
     L2: Elements of the array
 
+    Arrays are numpy views of filled part of preallocated buffers,
+    so appending is amortized and trimming from the start does not copy.
+    Generic data (resolution 0) has high and low equal to price.
     """
+    # Array name: data type
+    columns = (('time', np.uint32), ('price', np.float64), ('high', np.float64), ('low', np.float64))
+
     def __init__(self, resolution = 0):
-        self.time = array.array('I') # Unsigned int - 2 bytes
-        self.price = array.array('d') # Double - 8 bytes. Setting 'f' (4 bytes float) leads to incorrect values!
-        self.high = array.array('d') # Period's highest price
-        self.low = array.array('d') # Period's lowest price
+        self.buffers = dict((name, np.empty(16, dtype=dtype)) for name, dtype in self.columns)
+        # Filled part of buffers
+        self.start = 0
+        self.end = 0
 
         self.resolution = resolution # Accepting only closing price of such intervals (e.g. 5 min, 30 min, 1h), in seconds
         self.append_tries = 0
         self.update_count = 0
 
+    @property
+    def time(self):
+        return self.buffers['time'][self.start:self.end]
+
+    @property
+    def price(self):
+        return self.buffers['price'][self.start:self.end]
+
+    @property
+    def high(self):
+        return self.buffers['high'][self.start:self.end]
+
+    @property
+    def low(self):
+        return self.buffers['low'][self.start:self.end]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, count):
+        """ Make room for count more elements """
+        size = len(self)
+        if self.end + count <= len(self.buffers['time']):
+            return
+
+        capacity = len(self.buffers['time'])
+        # Grow only if less than half of buffers would be used after moving data to the start
+        if size + count > capacity // 2:
+            capacity = max(capacity * 2, size + count)
+        for name, dtype in self.columns:
+            buffer = np.empty(capacity, dtype=dtype)
+            buffer[:size] = self.buffers[name][self.start:self.end]
+            self.buffers[name] = buffer
+        self.start = 0
+        self.end = size
+
+    def write(self, time, price, high, low):
+        """ Append arrays or lists of values """
+        count = len(time)
+        self.reserve(count)
+        for name, values in (('time', time), ('price', price), ('high', high), ('low', low)):
+            self.buffers[name][self.end:self.end + count] = values
+        self.end += count
+
+    def trim(self, count):
+        """ Drop first count elements """
+        self.start = min(self.start + count, self.end)
+
     def set_interval_end(self, time):
         # If resolution 0 - let every line be written
         if self.resolution == 0:
@@ -39,17 +95,11 @@ class Data(object):
             # Calculate next interval end based on received current time
             self.interval_end = (time//self.resolution + 1) * self.resolution
 
-    # Fill empty intervals with previous data
-    def fill_empty_intervals(self, time, to_write):
+    # Times of empty intervals to fill with previous data
+    def empty_intervals(self, time):
         # How many intervals missed?
         intervals_missed = (time - self.interval_end) // self.resolution
-
-        if intervals_missed > 0:
-            for i in range (1, intervals_missed + 1):
-                self.time.append(self.interval_end + self.resolution * i)
-                self.price.append(to_write['price'])
-                self.high.append(to_write['price'])
-                self.low.append(to_write['price'])
+        return [self.interval_end + self.resolution * i for i in range(1, intervals_missed + 1)]
 
     def append(self, time, price):
         time = int(time)
@@ -75,17 +125,20 @@ class Data(object):
 
         # If interval end passed - assign values from previous read
         if time - self.interval_end >= 0:
-            self.time.append(to_write['time'])
-            self.price.append(to_write['price'])
-
             # Do not fill empty intervals for generic data
             if time - self.interval_end > self.resolution and self.resolution != 0:
-                self.fill_empty_intervals(time, to_write)
+                missed = self.empty_intervals(time)
+            else:
+                missed = []
 
-            # Fill in high and low if this is not generic data
+            prices = [to_write['price']] * (len(missed) + 1)
+            # Missed intervals' high and low are written before closed interval's ones
             if self.resolution > 0:
-                self.high.append(self.current_high)
-                self.low.append(self.current_low)
+                highs = prices[1:] + [self.current_high]
+                lows = prices[1:] + [self.current_low]
+            else:
+                highs = lows = prices
+            self.write([to_write['time']] + missed, prices, highs, lows)
 
             self.last_line = {'time': time, 'price': price}
             self.set_interval_end(time)
@@ -101,10 +154,115 @@ class Data(object):
                 self.current_low = price
 
 
+    def extend(self, time, price):
+        """ Bulk append of time and price arrays.
+            Same result as calling append() for every pair """
+        time = np.asarray(time, dtype=np.int64)
+        price = np.asarray(price, dtype=np.float64)
+        if len(time) == 0:
+            return
+
+        # Generic data is written as is
+        if self.resolution == 0:
+            self.write(time, price, price, price)
+            self.append_tries += len(time)
+            return
+
+        # Every tick is a segment of its own
+        self.extend_segments(time, time, price, price, price)
+
+    def extend_segments(self, first, time, price, high, low):
+        """ Bulk append of tick segments, see tick_segments().
+            Ticks of one segment must fall into one interval of this resolution.
+
+            first - time of the first tick of segment
+            time, price - last tick of segment
+            high, low - highest and lowest price of segment
+
+            Same result as calling append() for every tick of every segment """
+        if len(first) == 0:
+            return
+
+        res = self.resolution
+
+        # Same initialization as in append()
+        if self.append_tries == 0:
+            self.last_line = {'time': int(time[0]), 'price': float(price[0])}
+            self.set_interval_end(int(first[0]))
+            self.current_high = float(high[0])
+            self.current_low = float(low[0])
+
+        self.append_tries += len(first)
+
+        # Current interval is always the highest one seen so far,
+        # because interval end only moves forward.
+        # Find it for every segment to handle out of order data the same way
+        seen = np.empty(len(first), dtype=np.int64)
+        seen[0] = self.interval_end // res - 1
+        np.maximum.accumulate(time[:-1] // res, out=seen[1:])
+        np.maximum(seen, seen[0], out=seen)
+
+        # Segments whose first tick passes interval end and closes previous interval.
+        # Other ticks of segment can't do it as they are in the same interval
+        closing = np.flatnonzero(first // res > seen)
+        new_high = np.maximum.reduceat(high, np.concatenate(([0], closing)))
+        new_low = np.minimum.reduceat(low, np.concatenate(([0], closing)))
+
+        if len(closing) == 0:
+            self.current_high = max(self.current_high, new_high[0])
+            self.current_low = min(self.current_low, new_low[0])
+            self.last_line = {'time': int(time[-1]), 'price': float(price[-1])}
+            return
+
+        # Values written for closed intervals are taken from the tick before closing one.
+        # Interval may be closed by the first segment, then it is the previous last_line
+        prev = closing - 1
+        close_time = np.where(prev >= 0, time[prev], self.last_line['time'])
+        close_price = np.where(prev >= 0, price[prev], self.last_line['price'])
+
+        # High and low of closed intervals, first one continues previous state
+        high = new_high[:-1]
+        low = new_low[:-1]
+        if closing[0] == 0:
+            high[0] = self.current_high
+            low[0] = self.current_low
+        else:
+            high[0] = max(self.current_high, high[0])
+            low[0] = min(self.current_low, low[0])
+
+        # Empty intervals to fill, see fill_empty_intervals()
+        interval_end = (seen[closing] + 1) * res
+        passed = first[closing] - interval_end
+        missed = np.where(passed > res, passed // res, 0)
+
+        # Every closed interval writes itself plus missed ones after it
+        count = missed + 1
+        block_start = np.cumsum(count) - count
+        position = np.arange(count.sum()) - np.repeat(block_start, count)
+
+        out_time = np.repeat(interval_end, count) + res * position
+        out_time[block_start] = close_time
+        out_price = np.repeat(close_price, count)
+        # Missed intervals' high and low are written before closed interval's ones
+        out_high = out_price.copy()
+        out_high[block_start + missed] = high
+        out_low = out_price.copy()
+        out_low[block_start + missed] = low
+
+        self.write(out_time, out_price, out_high, out_low)
+
+        # State of the interval in progress
+        self.last_line = {'time': int(time[-1]), 'price': float(price[-1])}
+        self.set_interval_end(int(first[closing[-1]]))
+        self.current_high = float(new_high[-1])
+        self.current_low = float(new_low[-1])
+
     def update(self, time, price):
         """ Overwrite last values or shift all data
             by one in case resolution border is crossed.
-            Used for realtime updates """
+            Used for realtime updates.
+            Returns True if new element was added, False if
+            the last one was overwritten, None if data is older """
         time = int(time)
         price = float(price)
 
@@ -126,28 +284,199 @@ class Data(object):
 
         # If arrived data is newer - write
         if time > self.time[-1]:
+            new_element = self.update_count == 0 or element_n == 0
             # Remove if this is not the first update
             if self.update_count > 0:
-                self.time.pop(element_n)
-                self.price.pop(element_n)
-                self.high.pop(element_n)
-                self.low.pop(element_n)
+                if element_n == 0:
+                    self.start += 1
+                else:
+                    self.end -= 1
 
             # And write new value
-            self.time.append(time)
-            self.price.append(price)
-            self.high.append(self.current_high)
-            self.low.append(self.current_low)
+            self.write([time], [price], [self.current_high], [self.current_low])
             # Update end of interval
             self.set_interval_end(time)
             self.update_count += 1
+            return new_element
         else:
-            pass
+            return None
 
     def read(self, index):
-        output = {'time': self.time[index], 'price': self.price[index]}
+        output = {'time': int(self.time[index]), 'price': float(self.price[index])}
         return output
 
+    def arrays(self):
+        """ Dictionary of data arrays """
+        return {'time': self.time, 'price': self.price, 'high': self.high, 'low': self.low}
+
+    def load_arrays(self, arrays):
+        """ Replace data with copies of arrays in format of arrays() """
+        self.buffers = dict((name, np.array(arrays[name], dtype=dtype)) for name, dtype in self.columns)
+        self.start = 0
+        self.end = len(self.buffers['time'])
+
+    def interval_state(self):
+        """ Dictionary of the interval in progress, None before the first tick.
+            Data restored by load_arrays() and load_interval_state()
+            is extended by next ticks as if it was never saved """
+        if self.append_tries == 0:
+            return None
+        return {'line_time': self.last_line['time'], 'line_price': self.last_line['price'],
+                'interval_end': self.interval_end, 'current_high': self.current_high,
+                'current_low': self.current_low, 'append_tries': self.append_tries}
+
+    def load_interval_state(self, state):
+        """ Restore state of interval_state() """
+        self.last_line = {'time': int(state['line_time']), 'price': float(state['line_price'])}
+        self.interval_end = int(state['interval_end'])
+        self.current_high = float(state['current_high'])
+        self.current_low = float(state['current_low'])
+        self.append_tries = int(state['append_tries'])
+
+
+# Split ticks into runs of consecutive ticks in the same interval
+def tick_segments(time, price, resolution, splits=()):
+    """
+    Segment is also split when one of splits times is crossed,
+    so it is either fully before or fully at/after every split.
+
+    Returns arrays for Data.extend_segments() and the number
+    of splits at or before every segment
+    """
+    interval = time // resolution
+    rank = np.searchsorted(np.sort(splits), time, side='right')
+
+    starts = np.flatnonzero((interval[1:] != interval[:-1]) | (rank[1:] != rank[:-1])) + 1
+    ends = np.append(starts, len(time)) - 1
+    starts = np.insert(starts, 0, 0)
+
+    return ((time[starts], time[ends], price[ends],
+             np.maximum.reduceat(price, starts), np.minimum.reduceat(price, starts)),
+            rank[starts])
+
+
+class Resampler(object):
+    """
+    Fills Data objects of all resolutions from one tick stream
+
+    Resolution which is a multiple of a finer configured one is built
+    from its segments (see tick_segments()) instead of ticks.
+    Every Data object gets only ticks at or after its lookback time.
+
+    Structure:
+        self.data - dictionary of resolution name: Data object
+        self.groups - dictionary of base resolution value: resolution names built from it
+    """
+    def __init__(self, resolutions, lookbacks):
+        self.resolutions = resolutions
+        self.lookbacks = lookbacks
+        self.data = {}
+        self.groups = {}
+
+        for res_name, res_value in resolutions.items():
+            self.data[res_name] = Data(res_value)
+            # Finest configured resolution dividing this one
+            base = min(value for value in resolutions.values() if res_value % value == 0)
+            self.groups.setdefault(base, []).append(res_name)
+
+    def extend(self, time, price):
+        time = np.asarray(time, dtype=np.int64)
+        price = np.asarray(price, dtype=np.float64)
+        if len(time) == 0:
+            return
+
+        for base, res_names in self.groups.items():
+            # Single resolution - feed ticks directly
+            if len(res_names) == 1:
+                res_name = res_names[0]
+                in_range = time >= self.lookbacks[res_name]
+                self.data[res_name].extend(time[in_range], price[in_range])
+                continue
+
+            splits = np.sort([self.lookbacks[res_name] for res_name in res_names])
+            segments, rank = tick_segments(time, price, base, splits)
+
+            for res_name in res_names:
+                # Number of splits at or before lookback time of this resolution
+                threshold = np.searchsorted(splits, self.lookbacks[res_name], side='right')
+                in_range = rank >= threshold
+                self.data[res_name].extend_segments(*(values[in_range] for values in segments))
+
+# Simple moving average, partial sums divided by period at the start
+def sma(price, period, csum=None, out=None):
+    """
+    csum - cumulative sum of price, to be shared by all periods
+    out - array to write averages to
+    """
+    if csum is None:
+        csum = np.cumsum(price, dtype=np.float64)
+    if out is None:
+        out = np.empty(len(csum))
+    out[:] = csum
+    out[period:] -= csum[:-period]
+    out /= period
+    return out
+
+
+# Length of blocks ema() is computed by
+def ema_block(period):
+    decay = 1 - 2. / (period + 1)
+    if decay == 0:
+        return 1
+    return max(int(np.log(1e3) / -np.log(decay)), 1)
+
+
+# Exponential moving average with recursion y[i] = a*x[i] + (1-a)*y[i-1]
+def ema(price, period, initial=None):
+    """
+    a = 2 / (period + 1), first value is price itself.
+
+    Computed by blocks: inside a block recursion unrolls into a cumulative
+    sum of prices scaled by powers of (1-a), so only last values of blocks
+    are carried in a loop. Blocks are short enough for scaling to stay
+    below 1000 to keep precision.
+
+    initial - average before the first price. Averages of prices starting
+    at a block border (see ema_block()) continued from the average before
+    it are the same as averages of all prices
+    """
+    price = np.asarray(price, dtype=np.float64)
+    alpha = 2. / (period + 1)
+    decay = 1 - alpha
+    datalen = len(price)
+    if datalen == 0 or decay == 0:
+        return price.copy()
+
+    block = ema_block(period)
+    blocks = -(-datalen // block)
+    values = np.zeros(blocks * block)
+    values[:datalen] = price
+    values = values.reshape(blocks, block)
+
+    powers = decay ** np.arange(block)
+    # Averages of every block as if previous value was zero
+    averages = np.cumsum(values / powers, axis=1)
+    averages *= powers * alpha
+
+    # Add decayed last value of previous block
+    carry = powers * decay
+    last = price[0] if initial is None else initial
+    for averages_block in averages:
+        averages_block += carry * last
+        last = averages_block[-1]
+
+    return averages.reshape(-1)[:datalen]
+
+
+# Convolution with exponentially growing window weights
+def ema_window(price, period):
+    """ Former 'exp' average: window of period prices weighted by exp(-1..0) """
+    weights_ema = np.exp(np.linspace(-1., 0., period))
+    weights_ema /= weights_ema.sum()
+    weights_ema = weights_ema[::-1]
+    return np.convolve(price, weights_ema, mode='full')[:len(price)]
+
+
 # Moving averages class
 class MovingAverages(object):
     """
@@ -166,55 +495,90 @@ class MovingAverages(object):
 
     L3: Elements of the array
 
-    """
-    def __init__(self, data_obj, av_periods, realtime=False):
-        # Price array.array from data object of same resolution
-        data = data_obj.price
-        datalen = len(data)
-
-        self.ma = {'simple': {}, 'exp': {}}
-
-        '''
-        For all periods, create lists of arrays
-        and fill these arrays with calculated averages
-        '''
+    Averages are calculated on first access and kept until released
+    by release(), so only periods in use take time and memory.
 
-        if not realtime:
-            prog = Progress(max(av_periods))
+    ema_type - 'recursive' for true exponential average (see ema())
+               or 'window' for exponentially weighted window (see ema_window())
+    cache_obj - optional cache.DiskCache to keep calculated averages in,
+                entries are keyed by fingerprint of prices and parameters
+    """
+    def __init__(self, data_obj, av_periods, realtime=False, ema_type='recursive', cache_obj=None):
+        # Price array from data object of same resolution
+        self.price = data_obj.price
+        self.periods = list(av_periods)
+        self.ema_type = ema_type
+        self.cache_obj = cache_obj
+        self.fingerprint = None
+
+        if ema_type == 'recursive':
+            self.exp_average = ema
+        elif ema_type == 'window':
+            self.exp_average = ema_window
+        else:
+            raise ValueError("Unknown EMA type %s" % ema_type)
 
-        for period in av_periods:
-            # Create dictionaries of arrays
-            self.ma['simple'][period] = array.array('d') # Simple moving average
-            self.ma['exp'][period] = array.array('d') # Exponential moving average
+        # Cumulative sum of prices, shared by simple averages of all periods
+        self.csum = None
 
-            weights_sma = np.ones(period)
-            weights_ema = np.exp(np.linspace(-1., 0., period))
+        # If this is not one-time backtesting generation,
+        # first elements are cut as they are out of range.
+        # Data obj of given resolution is cut as well
+        if realtime:
+            self.cut = 0
+        else:
+            self.cut = max(av_periods)
+            data_obj.trim(self.cut)
+
+        self.ma = {'simple': LazyAverages(self, 'simple'), 'exp': LazyAverages(self, 'exp')}
+
+    def compute(self, ma_type, period):
+        """ Averages array of given type and period """
+        if self.cache_obj is not None:
+            if self.fingerprint is None:
+                self.fingerprint = cache.fingerprint(self.price)
+            # EMA type makes no difference for simple averages
+            key = cache.key('ma', self.fingerprint, ma_type, period,
+                            self.ema_type if ma_type == 'exp' else None, self.cut)
+            cached = self.cache_obj.load(key)
+            if cached is not None:
+                return cached['averages']
+
+        if ma_type == 'simple':
+            if self.csum is None:
+                self.csum = np.cumsum(self.price, dtype=np.float64)
+            averages = sma(self.price, period, self.csum)
+        else:
+            averages = self.exp_average(self.price, period)
+        averages = averages[self.cut:]
 
-            weights_sma /= weights_sma.sum()
-            weights_ema /= weights_ema.sum()
-            weights_ema = weights_ema[::-1]
+        if self.cache_obj is not None:
+            self.cache_obj.save(key, {'averages': averages})
+        return averages
 
-            # Add data from numpy convolution result list to arrays
-            self.ma['simple'][period].extend(np.convolve(data, weights_sma, mode='full')[:datalen])
-            self.ma['exp'][period].extend(np.convolve(data, weights_ema, mode='full')[:datalen])
+    def release(self, ma_type, period):
+        """ Free memory of averages array, it is calculated again on next access """
+        self.ma[ma_type].pop(period, None)
 
-            # If this is not one-time backtesting generation
-            if not realtime:
-                # Cut first elements as they are out of range
-                self.ma['simple'][period] = self.ma['simple'][period][max(av_periods):]
-                self.ma['exp'][period] = self.ma['exp'][period][max(av_periods):]
+    def matrix(self, ma_type, periods=None):
+        """ Matrix of shape (len(periods), len of dataobject), av_periods by default """
+        if periods is None:
+            periods = self.periods
+        return np.array([self.ma[ma_type][period] for period in periods])
 
-                prog.show(period)
 
-        # Loop end
+class LazyAverages(dict):
+    """ Dictionary of period: averages array of one type, see MovingAverages """
+    def __init__(self, av_obj, ma_type):
+        super().__init__()
+        self.av_obj = av_obj
+        self.ma_type = ma_type
 
-        if not realtime:
-            # Cut first elements for Data obj of given resolution as well
-            # TODO: Separate function for this
-            data_obj.time = data_obj.time[max(av_periods):]
-            data_obj.price = data_obj.price[max(av_periods):]
-            data_obj.high = data_obj.high[max(av_periods):]
-            data_obj.low = data_obj.low[max(av_periods):]
+    def __missing__(self, period):
+        if period not in self.av_obj.periods:
+            raise KeyError(period)
+        averages = self[period] = self.av_obj.compute(self.ma_type, period)
+        return averages
 
 
 # Parabolic stop-and-reverse implementation
@@ -227,8 +591,8 @@ class SAR(object):
         Array #2: SAR value
     """
     def __init__(self, data_obj, af_inc=0.02, af_max=0.2):
-        heights = data_obj.high
-        lows = data_obj.low
+        heights = data_obj.high.tolist()
+        lows = data_obj.low.tolist()
         datalen = len(heights)
 
         assert datalen == len(lows)
@@ -339,6 +703,286 @@ class SAR(object):
 
         assert len(self.trend) == len (self.sar) == datalen
 
+        # Numpy views of results
+        self.trend = np.frombuffer(self.trend, dtype=np.int16)
+        self.sar = np.frombuffer(self.sar, dtype=np.float64)
+
+
+
+# Parabolic SAR for a grid of parameters
+class SARGrid(object):
+    """
+    Same calculation as SAR for many (af_inc, af_max) pairs in one pass
+    over data, vectorized over pairs. Time of the pass hardly depends on
+    number of pairs, so small grids are calculated pair by pair by SAR.
+
+    Downtrend is handled as uptrend of negated prices: state is kept
+    multiplied by trend direction, which is exact for floats.
+
+    Structure:
+        self.params - list of (af_inc, af_max) pairs
+        Matrix #1: self.trend - trend direction, shape (len(params), len(data))
+        Matrix #2: self.sar - SAR values of the same shape
+
+    cache_obj - optional cache.DiskCache to keep calculated matrices in,
+                entries are keyed by fingerprint of highs and lows and parameters
+    """
+    # Smaller grids are faster to calculate pair by pair
+    min_vectorized = 32
+
+    def __init__(self, data_obj, params, cache_obj=None):
+        self.params = list(params)
+
+        if cache_obj is not None:
+            key = cache.key('sar', cache.fingerprint(data_obj.high, data_obj.low), self.params)
+            cached = cache_obj.load(key)
+            if cached is not None:
+                self.trend = cached['trend']
+                self.sar = cached['sar']
+                return
+
+        self.trend, self.sar = self.calculate(data_obj)
+
+        if cache_obj is not None:
+            cache_obj.save(key, {'trend': self.trend, 'sar': self.sar})
+
+    def calculate(self, data_obj):
+        """ Matrices of trend and SAR values """
+        if len(self.params) < self.min_vectorized:
+            singles = [SAR(data_obj, af_inc, af_max) for af_inc, af_max in self.params]
+            return (np.array([single.trend for single in singles]),
+                    np.array([single.sar for single in singles]))
+
+        heights = data_obj.high.tolist()
+        lows = data_obj.low.tolist()
+        datalen = len(heights)
+        size = len(self.params)
+
+        af_inc = np.array([param[0] for param in self.params], dtype=np.float64)
+        af_max = np.array([param[1] for param in self.params], dtype=np.float64)
+
+        # Rows are bars while calculating, transposed at the end
+        trend = np.empty((datalen, size), dtype=np.int16)
+        sar = np.empty((datalen, size))
+
+        # First position doesn't depend on parameters, see SAR.
+        # direction - trend, sar_dir and xp_dir - SAR and extreme point multiplied by it
+        if heights[1] > heights[0] or lows[0] < lows[1]:
+            direction = np.ones(size)
+            sar_dir = np.full(size, lows[0])
+            xp_dir = np.full(size, heights[0])
+        else:
+            direction = -np.ones(size)
+            sar_dir = np.full(size, -heights[0])
+            xp_dir = np.full(size, -lows[0])
+        trend[0] = direction
+        sar[0] = direction * sar_dir
+        af = af_inc.copy()
+
+        # Work arrays
+        up = np.empty(size, dtype=bool)
+        new_xp = np.empty(size, dtype=bool)
+        reverse = np.empty(size, dtype=bool)
+        high_dir = np.empty(size)
+        low_dir = np.empty(size)
+        prev_low_dir = np.empty(size)
+        tmp = np.empty(size)
+
+        for i in range(1, datalen):
+            # Prices as seen in trend direction
+            np.greater(direction, 0, out=up)
+            high_dir.fill(-lows[i])
+            np.copyto(high_dir, heights[i], where=up)
+            low_dir.fill(-heights[i])
+            np.copyto(low_dir, lows[i], where=up)
+            prev_low_dir.fill(-heights[i-1])
+            np.copyto(prev_low_dir, lows[i-1], where=up)
+
+            # New extreme point increases acceleration factor
+            np.greater(high_dir, xp_dir, out=new_xp)
+            np.copyto(xp_dir, high_dir, where=new_xp)
+            np.add(af, af_inc, out=tmp)
+            np.minimum(af_max, tmp, out=tmp)
+            np.copyto(af, tmp, where=new_xp)
+
+            # This period's SAR, can't be beyond previous low
+            np.subtract(xp_dir, sar_dir, out=tmp)
+            tmp *= af
+            sar_dir += tmp
+            np.minimum(sar_dir, prev_low_dir, out=sar_dir)
+
+            # Reversal: SAR is set to extreme point, extreme point to current price
+            np.less(low_dir, sar_dir, out=reverse)
+            if reverse.any():
+                np.negative(xp_dir, out=tmp)
+                np.copyto(sar_dir, tmp, where=reverse)
+                np.negative(low_dir, out=tmp)
+                np.copyto(xp_dir, tmp, where=reverse)
+                np.copyto(af, af_inc, where=reverse)
+                np.negative(direction, out=tmp)
+                np.copyto(direction, tmp, where=reverse)
+
+            trend[i] = direction
+            np.multiply(direction, sar_dir, out=sar[i])
+
+        return (np.ascontiguousarray(trend.T), np.ascontiguousarray(sar.T))
+
+    def series(self, index):
+        """ SAR-like object of one pair of parameters """
+        series = SARSeries()
+        series.trend = self.trend[index]
+        series.sar = self.sar[index]
+        return series
+
+
+class SARSeries(object):
+    """ One row of SARGrid, used in place of SAR """
+    pass
+
+
+class DataView(object):
+    """ Time and price arrays, used in place of Data by AveragesAnalytics """
+    def __init__(self, time, price):
+        self.time = time
+        self.price = price
+
+
+class AveragesView(object):
+    """
+    Rows of averages matrices, used in place of MovingAverages by AveragesAnalytics
+    matrices - dictionary of MA type: matrix of shape (len(periods), len of data)
+    """
+    def __init__(self, matrices, periods):
+        self.ma = dict((ma_type, dict(zip(periods, matrix))) for ma_type, matrix in matrices.items())
+
+    def release(self, ma_type, period):
+        self.ma[ma_type].pop(period, None)
+
+
+# Bars of trades made on buy and sell signals, one by one
+def signal_trades(buy, sell, holding=False):
+    """
+    Position starts without currency 2, or with it if holding. Buy is made
+    on a buy signal while not holding it, sell on a sell signal while
+    holding it, so returned indices are buys at even places and sells at
+    odd ones (the other way round if holding).
+    Buy and sell on the same bar are not possible.
+
+    Hops from a trade to the next opposite signal, so it works
+    when bars have both signals, unlike trade_flags()
+    """
+    signals = (np.flatnonzero(buy), np.flatnonzero(sell))
+    trades = []
+    index = -1
+    while True:
+        events = signals[(len(trades) + holding) % 2]
+        position = np.searchsorted(events, index, side='right')
+        if position == len(events):
+            break
+        index = events[position]
+        trades.append(index)
+    return np.array(trades, dtype=np.intp)
+
+
+# Trades of many rows of signals at once, see signal_trades()
+def trade_flags(buy, sell, holding=False):
+    """
+    buy, sell - boolean matrices of shape (rows, bars)
+    holding - position at start, for all rows or every row
+    Returns boolean matrix of the same shape, True at trade bars
+    """
+    buy = np.asarray(buy, dtype=bool)
+    sell = np.asarray(sell, dtype=bool)
+    rows, bars = buy.shape
+    holding = np.broadcast_to(np.asarray(holding, dtype=bool), (rows,))
+
+    # Position after every bar is the last signal before it, start position at start
+    signal = np.zeros((rows, bars + 1), dtype=np.int8)
+    signal[:, 0] = np.where(holding, 1, -1)
+    signal[:, 1:][buy] = 1
+    signal[:, 1:][sell] = -1
+    last = np.where(signal != 0, np.arange(bars + 1), 0)
+    np.maximum.accumulate(last, axis=1, out=last)
+    position = np.take_along_axis(signal, last, axis=1)
+    flags = position[:, 1:] != position[:, :-1]
+
+    # Bar with both signals always trades, such rows are resolved one by one
+    for row in np.flatnonzero((buy & sell).any(axis=1)):
+        flags[row] = False
+        flags[row, signal_trades(buy[row], sell[row], holding[row])] = True
+
+    return flags
+
+
+# Trades of one row of signals, see signal_trades()
+def trade_indices(buy, sell, holding=False):
+    return np.flatnonzero(trade_flags(np.asarray(buy)[np.newaxis], np.asarray(sell)[np.newaxis], holding)[0])
+
+
+# Largest positive value or zero
+def max_or_zero(values):
+    values = values[values > 0]
+    return float(values.max()) if len(values) else 0
+
+
+# Smallest negative value or zero
+def min_or_zero(values):
+    values = values[values < 0]
+    return float(values.min()) if len(values) else 0
+
+
+# Ledger row of one trade: buy and sell of the same amount
+LEDGER_DTYPE = np.dtype([('entry', np.int64), ('exit', np.int64),
+                         ('entry_price', np.float64), ('exit_price', np.float64),
+                         ('entry_sum', np.float64), ('exit_sum', np.float64)])
+
+
+# Ledger of trades made one after another
+def trade_ledger(bars, prices, sums):
+    """
+    bars, prices, sums - buys at even places and sells at odd ones.
+    Sum is currency 1 amount before buy and after sell.
+
+    Returns array of LEDGER_DTYPE, entry and exit are bar indices.
+    Position still open at the end has exit -1, exit price and sum NaN
+    """
+    bars = np.asarray(bars, dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float64)
+    sums = np.asarray(sums, dtype=np.float64)
+    exits = len(bars) // 2
+
+    ledger = np.empty((len(bars) + 1) // 2, dtype=LEDGER_DTYPE)
+    ledger['entry'] = bars[0::2]
+    ledger['entry_price'] = prices[0::2]
+    ledger['entry_sum'] = sums[0::2]
+    ledger['exit'] = -1
+    ledger['exit'][:exits] = bars[1::2]
+    ledger['exit_price'] = np.nan
+    ledger['exit_price'][:exits] = prices[1::2]
+    ledger['exit_sum'] = np.nan
+    ledger['exit_sum'][:exits] = sums[1::2]
+    return ledger
+
+
+# Trades of ledger as trade_ledger() takes them
+def ledger_trades(ledger):
+    """ Returns list of (bar index, price, sum), buys at even places and sells at odd ones """
+    trades = []
+    for trade in ledger.tolist():
+        entry, exit, entry_price, exit_price, entry_sum, exit_sum = trade
+        trades.append((entry, entry_price, entry_sum))
+        if exit >= 0:
+            trades.append((exit, exit_price, exit_sum))
+    return trades
+
+
+# Results of one pair, see AveragesAnalytics
+RESULT_DTYPE = np.dtype([('tested', bool), ('end_sum', np.float64), ('profit', np.float64), ('transactions', np.int64),
+                         ('biggest_win', np.float64), ('biggest_loss', np.float64),
+                         ('won_trades_sum', np.float64), ('lost_trades_sum', np.float64),
+                         ('won_trades_num', np.int64), ('lost_trades_num', np.int64),
+                         ('max_consecutive_wins', np.int64), ('max_consecutive_losts', np.int64),
+                         ('max_consecutive_profit', np.float64), ('max_consecutive_loss', np.float64)])
 
 
 class AveragesAnalytics(object):
@@ -347,23 +991,15 @@ class AveragesAnalytics(object):
 
     L0: Separate object for every resolution (5m, 1h, etc.)
         Usually objects are put in a dictionary with corresponding keys
-        Includes multilevel dictionaries of the following data:
-
-        L1: self.minimum_profit - MA type minimum profit (percent)
-        L1: self.average_profit - MA type average profit (percent)
-        L1: self.maximum_profit - MA type maximum profit (percent)
-        L2: self.current_sum - list of (<currency1_amount>, <currency2_amount>)
-        L2: self.end_sum - last value of <currency1_amount>
-        L2: self.profit - percent, end_sum/startsum
-        L2: self.transactions - value of number of successful buys+sells
-
-    L1: MA type as a key (simple or exponential)
-        Value is a dictionary of L2 or a variable of L1
-        <name>{ma_type}{av_pair_list}
-
-    L2: Dictionary of average periods, pair list as a key (eg. (1, 2), (1, 3) etc.)
-        Values are actual data
-        <name>{ma_type}{av_pair_list} - for results of stats() function:
+
+    L1: self.results - structured array of RESULT_DTYPE,
+        shape (len(self.ma_types), max period + 1, max period + 1)
+        Element [ma_index][fast_period][slow_period] keeps pair results:
+            tested - if pair was tested
+            end_sum - last value of <currency1_amount>, NaN if nothing was sold
+            profit - percent, end_sum/startsum
+            transactions - number of successful buys+sells
+            and results of stats() function:
             biggest_win
             biggest_loss
             won_trades_sum
@@ -375,40 +1011,51 @@ class AveragesAnalytics(object):
             max_consecutive_profit
             max_consecutive_loss
 
-            last_buy_trade
-            last_sell_trade
+    L1: self.minimum_profit - MA type minimum profit (percent)
+    L1: self.average_profit - MA type average profit (percent)
+    L1: self.maximum_profit - MA type maximum profit (percent)
+        Dictionaries with MA type as a key (simple or exponential)
 
-        or
-        <name>{ma_type}[fast_period][slow_period] - for general pair calculation:
-            end_sum
-            profit
+    L1: self.ledger - dictionary of MA type: dictionary of pair: array of trades,
+        see trade_ledger()
 
+    self.pairs - tested pairs in order of testing
+    self.thresholds, self.threshold_profit - thresholds sweep, see sweep_thresholds()
+    self.info - dictionary of run description saved with results, see save()
 
+    Simulation state of pair being tested:
+        self.current_sum - list of (<currency1_amount>, <currency2_amount>)
+        self.transactions - number of trades made
     """
     def __init__(self, res, fee, algo):
         self.resolution = res
         self.fee = float(fee)
         self.algorithm = int(algo)
         self.startsum = 100
-        # Stats
-        self.biggest_win = {}
-        self.biggest_loss = {}
-        self.won_trades_sum = {}
-        self.lost_trades_sum = {}
-        self.won_trades_num = {}
-        self.lost_trades_num = {}
-        self.max_consecutive_wins = {}
-        self.max_consecutive_losts = {}
-        self.max_consecutive_profit = {}
-        self.max_consecutive_loss = {}
-
-        # Stats helper vars
-        self.last_buy_trade = {}
-        self.last_sell_trade = {}
 
+        # Results
+        self.ma_types = ()
+        self.pairs = []
+        self.results = None
+        self.info = {}
+
+        self.minimum_profit = {}
+        self.average_profit = {}
+        self.maximum_profit = {}
+
+        # Trades
+        self.ledger = {}
 
     # Backtesting sequence
-    def backtest(self, av_obj, data_obj, av_periods, av_pairs, sar_obj, threshold_buy, threshold_sell):
+    def backtest(self, av_obj, data_obj, av_periods, av_pairs, sar_obj, threshold_buy, threshold_sell,
+                 ma_variants=('simple', 'exp'), engine='vector', grid_memory=256*1024*1024):
+        """
+        engine - 'vector' to find trades from signal arrays (see signals()),
+                 'grid' to do the same for blocks of pairs at once (see backtest_grid()),
+                 'loop' to step through every bar calling decision().
+                 Results are the same
+        grid_memory - memory limit of 'grid' engine in bytes
+        """
         self.avdata = av_obj
         self.data = data_obj
         self.sar = sar_obj
@@ -416,133 +1063,504 @@ class AveragesAnalytics(object):
         self.t_buy = float(threshold_buy)
         self.t_sell = float(threshold_sell)
 
-        self.ma_variants = ('simple', 'exp')
-        self.current_sum = {}
-        self.end_sum = {}
-        self.profit = {}
-        self.transactions = {}
+        self.ma_variants = ma_variants
+        self.init_results(ma_variants, av_periods, av_pairs)
 
-        self.minimum_profit = {}
-        self.average_profit = {}
-        self.maximum_profit = {}
+        # Plain lists are indexed faster than arrays
+        prices = self.data.price.tolist()
+        trend = self.sar.trend.tolist()
+        trend_array = np.asarray(self.sar.trend)
 
         # For both SMA and EMA variants, do...
         for ma in self.ma_variants:
 
             print ("Calculating profits for %s '%s'" % (self.resolution, ma))
-            # Current amount of currencies of each pair
-            self.current_sum[ma] = {}
-            # Init empty masked 2-dimensional numpy arrays for end_sum and profit
-            dimension = max(av_periods)+1
-            self.end_sum[ma] = np.ma.empty((dimension, dimension))
-            self.end_sum[ma][:] = np.NaN
-            self.profit[ma] = np.ma.empty((dimension, dimension))
-            self.profit[ma][:] = np.NaN
-            # Dictionary of number of transactions of each pair
-            self.transactions[ma] = {}
 
-            self.minimum_profit[ma] = 0
-            self.average_profit[ma] = 0
-            self.maximum_profit[ma] = 0
+            prog = Progress(len(av_pairs))
+
+            # Number of pairs still to test for every period.
+            # Averages are released when no pair needs them anymore
+            pending = {}
+            for av_pair in av_pairs:
+                for period in av_pair:
+                    pending[period] = pending.get(period, 0) + 1
 
-            self.biggest_win[ma] = {}
-            self.biggest_loss[ma] = {}
-            self.won_trades_sum[ma] = {}
-            self.lost_trades_sum[ma] = {}
-            self.won_trades_num[ma] = {}
-            self.lost_trades_num[ma] = {}
-            self.max_consecutive_wins[ma] = {}
-            self.max_consecutive_losts[ma] = {}
-            self.max_consecutive_profit[ma] = {}
-            self.max_consecutive_loss[ma] = {}
+            # All pairs at once, by blocks
+            if engine == 'grid':
+                self.backtest_grid(ma, av_pairs, prices, trend_array, grid_memory, pending, prog)
+            else:
+                # Slow and fast MA intersections. All combinations
+                for pair_number, av_pair in enumerate(av_pairs):
+                    # Set fast and slow averages periods
+                    fast_period, slow_period = av_pair
+
+                    av_datalength = len(self.avdata.ma[ma][fast_period])
+                    self.init_pair()
+
+                    # Sum after the last sell, None if there were no sells
+                    end_sum = None
+
+                    if engine == 'vector':
+                        # Find trades from signal arrays, only trades are simulated one by one
+                        buy, sell = self.signals(self.avdata.ma[ma][fast_period], self.avdata.ma[ma][slow_period], trend_array)
+                        end_sum = self.follow_signals(buy, sell, prices)
+
+                    else:
+                        # Prevent instant buy
+                        self.buy_allowed = False
+
+                        # Iterate over averages data to find intersections
+                        fast_values = self.avdata.ma[ma][fast_period].tolist()
+                        slow_values = self.avdata.ma[ma][slow_period].tolist()
+                        for index in range(av_datalength):
+                            fast = fast_values[index]
+                            slow = slow_values[index]
+
+                            # If able to buy
+                            if self.current_sum[0] > 0 \
+                              and self.decision('buy', fast, slow, trend[index]):
+                                self.trade('buy', index, prices[index])
+
+                            # Else, if able to sell
+                            elif self.current_sum[1] > 0 \
+                              and self.decision('sell', fast, slow, trend[index]):
+                                self.trade('sell', index, prices[index])
+                                end_sum = self.current_sum[0]
+
+
+                    # When buying simulation for this pair is finished - record trades, end_sum and profit
+                    trades = np.array(self.pair_trades, dtype=[('bar', np.int64), ('price', np.float64), ('sum', np.float64)])
+                    self.ledger[ma][av_pair] = trade_ledger(trades['bar'], trades['price'], trades['sum'])
+                    result = self.result(ma, av_pair)
+                    result['tested'] = True
+                    result['transactions'] = self.transactions
+                    if end_sum is not None:
+                        result['end_sum'] = end_sum
+                    result['profit'] = (result['end_sum'] - self.startsum) * 100 / self.startsum
+                    self.stats(ma, av_pair)
+
+                    self.release_pair(ma, av_pair, pending)
+
+                    prog.show(pair_number)
+                    # end intra-pair simulation loop
+
+            # end av_pairs loop
 
-            self.last_buy_trade[ma] = {}
-            self.last_sell_trade[ma] = {}
+            self.summarize(ma)
+
+        # end ma type loop
+
+    # end backtest function
+
+    # Algorithm #3 backtest of all thresholds combinations at once
+    def sweep_thresholds(self, av_obj, data_obj, av_periods, av_pairs, thresholds_buy, thresholds_sell,
+                         ma_variants=('simple', 'exp'), grid_memory=256*1024*1024):
+        """
+        Relative difference between MAs (see decision()) is calculated once for
+        every pair and compared with thresholds of all combinations, which are
+        rows of signals matrices simulated together (see simulate_rows()).
+
+        Fills self.thresholds - list of (buy, sell) thresholds combinations and
+        self.threshold_profit - profit cube of shape
+            (len(self.ma_types), max period + 1, max period + 1, len(self.thresholds)),
+            NaN where nothing was sold or pair was not tested
+        Profits are the same as backtest() gives with the same thresholds
+        """
+        self.avdata = av_obj
+        self.data = data_obj
+
+        self.ma_types = tuple(ma_variants)
+        self.pairs = list(av_pairs)
+        self.thresholds = list(itertools.product((float(value) for value in thresholds_buy),
+                                                 (float(value) for value in thresholds_sell)))
+        dimension = max(av_periods)+1
+        self.threshold_profit = np.full((len(self.ma_types), dimension, dimension, len(self.thresholds)), np.nan)
+
+        # Thresholds of combination in every row
+        t_buy = np.array([[buy] for buy, sell in self.thresholds])
+        t_sell = np.array([[sell] for buy, sell in self.thresholds])
+
+        price_array = np.asarray(self.data.price, dtype=np.float64)
+        datalen = len(price_array)
+        block_size = max(grid_memory // (max(datalen, 1) * self.grid_cell_bytes), 1)
+
+        for ma_index, ma in enumerate(self.ma_types):
+            print ("Sweeping %d thresholds for %s '%s'" % (len(self.thresholds), self.resolution, ma))
 
             prog = Progress(len(av_pairs))
 
-            # Slow and fast MA intersections. All combinations
+            pending = {}
+            for av_pair in av_pairs:
+                for period in av_pair:
+                    pending[period] = pending.get(period, 0) + 1
+
             for pair_number, av_pair in enumerate(av_pairs):
-                # Set fast and slow averages periods
-                fast_period, slow_period = av_pair
+                fast_ma = np.asarray(self.avdata.ma[ma][av_pair[0]])
+                slow_ma = np.asarray(self.avdata.ma[ma][av_pair[1]])
+                # Same expression as in decision() to get the same rounding
+                ma_dif = 100 * (fast_ma - slow_ma) / ((fast_ma + slow_ma)/2)
+
+                # Combinations are taken by blocks which fit memory
+                for first in range(0, len(self.thresholds), block_size):
+                    last = first + block_size
+                    end_sum = self.simulate_rows(ma_dif > t_buy[first:last], ma_dif < -t_sell[first:last], price_array)[3]
+                    self.threshold_profit[ma_index, av_pair[0], av_pair[1], first:last] = (end_sum - self.startsum) * 100 / self.startsum
+
+                self.release_pair(ma, av_pair, pending)
 
-                av_datalength = len(self.avdata.ma[ma][fast_period])
-                self.current_sum[ma][av_pair] = [float(self.startsum), 0.]
-                self.transactions[ma][av_pair] = 0
-
-                self.biggest_win[ma][av_pair] = 0
-                self.biggest_loss[ma][av_pair] = 0
-                self.won_trades_sum[ma][av_pair] = 0
-                self.lost_trades_sum[ma][av_pair] = 0
-                self.won_trades_num[ma][av_pair] = 0
-                self.lost_trades_num[ma][av_pair] = 0
-                self.max_consecutive_wins[ma][av_pair] = 0
-                self.max_consecutive_losts[ma][av_pair] = 0
-                self.max_consecutive_profit[ma][av_pair] = 0
-                self.max_consecutive_loss[ma][av_pair] = 0
-
-                self.last_buy_trade[ma][av_pair] = {"sum": 0}
-
-                # ..._seq_... keys are for current win/lost sequence counting
-                self.last_sell_trade[ma][av_pair] = {"result": "",
-                    "current_seq_count": 0, "current_seq_start_sum": 0}
-
-                # Prevent instant buy
-                self.buy_allowed = False
-
-                # Iterate over averages data to find intersections
-                for index in range(av_datalength):
-                    fast = self.avdata.ma[ma][fast_period][index]
-                    slow = self.avdata.ma[ma][slow_period][index]
-
-                    # If able to buy
-                    if self.current_sum[ma][av_pair][0] > 0 \
-                      and self.decision('buy', fast, slow, self.sar.trend[index]):
-
-                        # Get price from data object
-                        price = self.data.price[index]
-                        # Record buying action in stats()
-                        self.stats(ma, av_pair, 'buy', self.current_sum[ma][av_pair][0],
-                            self.data.time[index], price)
-                        # Simulate buy
-                        self.buy_sell_sim(price, 'buy', self.current_sum[ma][av_pair])
-                        self.transactions[ma][av_pair] += 1
-
-                    # Else, if able to sell
-                    elif self.current_sum[ma][av_pair][1] > 0 \
-                      and self.decision('sell', fast, slow, self.sar.trend[index]):
-                        # Get price from data object
-                        price = self.data.price[index]
-                        # Simulate sell
-                        self.buy_sell_sim(price, 'sell', self.current_sum[ma][av_pair])
-                        # Set end sum to current sum in case this is the last sell
-                        self.end_sum[ma][fast_period][slow_period] = self.current_sum[ma][av_pair][0]
-                        # Calculate after-sell statistics
-                        self.stats(ma, av_pair, 'sell', self.current_sum[ma][av_pair][0],
-                            self.data.time[index], price)
-                        self.transactions[ma][av_pair] += 1
-
-
-                # When buying simulation for this pair is finished - record end_sum and profit
-                self.profit[ma][fast_period][slow_period] = (self.end_sum[ma][fast_period][slow_period] - self.startsum) * 100 / self.startsum
                 prog.show(pair_number)
-                # end intra-pair simulation loop
 
-            # end av_pairs loop
+    # Save results of sweep_thresholds() to compressed .npz file
+    def save_thresholds(self, path):
+        info = dict(('info_' + key, value) for key, value in self.info.items())
+        np.savez_compressed(path, profit=self.threshold_profit, thresholds=np.array(self.thresholds).reshape(-1, 2),
+                            ma_types=np.array(self.ma_types), pairs=np.array(self.pairs, dtype=np.int64).reshape(-1, 2),
+                            resolution=self.resolution, fee=self.fee, algorithm=self.algorithm, **info)
+
+    # Empty results of all MA types
+    def init_results(self, ma_types, av_periods, av_pairs):
+        self.ma_types = tuple(ma_types)
+        self.pairs = list(av_pairs)
+        dimension = max(av_periods)+1
+        self.results = np.zeros((len(self.ma_types), dimension, dimension), dtype=RESULT_DTYPE)
+        self.results['end_sum'] = np.nan
+        self.results['profit'] = np.nan
+
+        for ma in self.ma_types:
+            self.minimum_profit[ma] = 0
+            self.average_profit[ma] = 0
+            self.maximum_profit[ma] = 0
+            self.ledger[ma] = {}
+
+    # Results of pair, element of self.results. Changes go to self.results
+    def result(self, ma, av_pair):
+        return self.results[self.ma_types.index(ma), av_pair[0], av_pair[1]]
+
+    # Matrix [fast_period][slow_period] of one result field with untested pairs masked
+    def matrix(self, name, ma):
+        index = self.ma_types.index(ma)
+        return np.ma.masked_array(self.results[name][index], mask=~self.results['tested'][index])
+
+    # Profit summary of MA type when all pairs are tested
+    def summarize(self, ma):
+        # Mask NaN values to exclude from calculations
+        profit = np.ma.masked_invalid(self.matrix('profit', ma))
+        self.minimum_profit[ma] = profit.min()
+        self.average_profit[ma] = profit.mean()
+        self.maximum_profit[ma] = profit.max()
+
+        print ("%s %s profit/lost: min %.2f%% av %.2f%% max %.2f%%" % (self.resolution, ma, self.minimum_profit[ma], self.average_profit[ma], self.maximum_profit[ma]))
+
+    # Results of pairs tested, to be merged into another object by merge()
+    def pair_results(self, ma, av_pairs):
+        fast_index = [av_pair[0] for av_pair in av_pairs]
+        slow_index = [av_pair[1] for av_pair in av_pairs]
+        return {'results': self.results[self.ma_types.index(ma), fast_index, slow_index],
+                'ledger': dict((av_pair, self.ledger[ma][av_pair]) for av_pair in av_pairs)}
+
+    # Add results of pair_results() to results of MA type
+    def merge(self, ma, av_pairs, results):
+        fast_index = [av_pair[0] for av_pair in av_pairs]
+        slow_index = [av_pair[1] for av_pair in av_pairs]
+        self.results[self.ma_types.index(ma), fast_index, slow_index] = results['results']
+        self.ledger[ma].update(results['ledger'])
+
+    # Dictionary of arrays saved by save()
+    def arrays(self):
+        """ Everything but ledgers, see save_ledger(). Values of self.info are saved as info_<key> """
+        arrays = dict(('info_' + key, value) for key, value in self.info.items())
+        arrays.update(results=self.results, ma_types=np.array(self.ma_types),
+                      pairs=np.array(self.pairs, dtype=np.int64).reshape(-1, 2),
+                      resolution=self.resolution, fee=self.fee, algorithm=self.algorithm)
+        return arrays
+
+    # Save results to compressed .npz file
+    def save(self, path):
+        np.savez_compressed(path, **self.arrays())
+
+    # Analytics object with results of arrays() from loaded .npz file
+    @classmethod
+    def from_arrays(cls, saved):
+        analytics = cls(str(saved['resolution']), float(saved['fee']), int(saved['algorithm']))
+        analytics.results = np.array(saved['results'])
+        analytics.ma_types = tuple(str(ma) for ma in saved['ma_types'])
+        analytics.pairs = [tuple(pair) for pair in saved['pairs'].tolist()]
+        analytics.info = dict((key[5:], saved[key].item()) for key in saved.files if key.startswith('info_'))
+        return analytics
+
+    # Analytics object with results saved by save()
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            analytics = cls.from_arrays(saved)
+
+        for ma in analytics.ma_types:
+            analytics.summarize(ma)
+        return analytics
+
+    # Save ledgers of all pairs to compressed .npz file
+    def save_ledger(self, path):
+        """ Arrays are named <MA type>-<fast period>-<slow period> """
+        ledgers = {}
+        for ma, pairs in self.ledger.items():
+            for (fast_period, slow_period), ledger in pairs.items():
+                ledgers['%s-%d-%d' % (ma, fast_period, slow_period)] = ledger
+        np.savez_compressed(path, **ledgers)
+
+    # Initial simulation state of pair
+    def init_pair(self):
+        self.current_sum = [float(self.startsum), 0.]
+        self.transactions = 0
+
+        # Trades of pair being tested: (bar index, price, sum)
+        self.pair_trades = []
+
+    # Release averages no other pair needs after this one
+    def release_pair(self, ma, av_pair, pending):
+        for period in av_pair:
+            pending[period] -= 1
+            if pending[period] == 0:
+                self.avdata.release(ma, period)
+
+    # Bytes of memory taken by one bar of one pair in backtest_grid()
+    grid_cell_bytes = 64
+
+    # Backtest of many pairs at once
+    def backtest_grid(self, ma, av_pairs, prices, trend, memory, pending, prog):
+        """
+        Pairs are taken by blocks which fit memory bytes. Fast and slow
+        averages of a block are matrices (pair, bar), so signals and trades
+        of all pairs come from a few operations on them (see trade_flags()).
+        Trades are simulated for all pairs of block at once (see simulate_rows()).
+        """
+        datalen = len(prices)
+        price_array = np.array(prices)
+        block_size = max(memory // (max(datalen, 1) * self.grid_cell_bytes), 1)
+        ma_index = self.ma_types.index(ma)
 
-            # Mask NaN values to exclude from calculations
-            self.end_sum[ma] = np.ma.masked_invalid(self.end_sum[ma])
-            self.profit[ma] = np.ma.masked_invalid(self.profit[ma])
-            self.minimum_profit[ma] = self.profit[ma].min()
-            self.average_profit[ma] = self.profit[ma].mean()
-            self.maximum_profit[ma] = self.profit[ma].max()
+        for first in range(0, len(av_pairs), block_size):
+            block = av_pairs[first:first + block_size]
+            rows = len(block)
 
-            print ("%s %s profit/lost: min %.2f%% av %.2f%% max %.2f%%" % (self.resolution, ma, self.minimum_profit[ma], self.average_profit[ma], self.maximum_profit[ma]))
+            fast = np.empty((rows, datalen))
+            slow = np.empty((rows, datalen))
+            for row, (fast_period, slow_period) in enumerate(block):
+                fast[row] = self.avdata.ma[ma][fast_period]
+                slow[row] = self.avdata.ma[ma][slow_period]
 
-        # end ma type loop
+            buy, sell = self.signals(fast, slow, trend)
+            del fast, slow
+            bars, trade_sum, executed, end_sum = self.simulate_rows(buy, sell, price_array)
+            del buy, sell
 
-    # end backtest function
+            fast_index = [pair[0] for pair in block]
+            slow_index = [pair[1] for pair in block]
+            self.results['tested'][ma_index, fast_index, slow_index] = True
+            self.results['transactions'][ma_index, fast_index, slow_index] = executed
+            self.results['end_sum'][ma_index, fast_index, slow_index] = end_sum
+            self.results['profit'][ma_index, fast_index, slow_index] = (end_sum - self.startsum) * 100 / self.startsum
+
+            for row, av_pair in enumerate(block):
+                pair_bars = bars[row, :executed[row]]
+                self.ledger[ma][av_pair] = trade_ledger(pair_bars, price_array[pair_bars], trade_sum[row, :executed[row]])
+                self.stats(ma, av_pair)
+
+                self.release_pair(ma, av_pair, pending)
+
+            prog.show(first + rows - 1)
+
+
+    # Trades of many rows of signals at once
+    def simulate_rows(self, buy, sell, price_array):
+        """
+        buy, sell - boolean matrices of shape (rows, bars)
+        Trades are simulated for all rows at once, trade by trade,
+        with the same operations as buy_sell_sim(), so sums are the same.
+
+        Returns matrices (row, trade number) of trade bars and sums, as
+        trade_ledger() takes them, numbers of executed trades and end sums
+        of rows, NaN where nothing was sold
+        """
+        rows = len(buy)
+        trade_rows, trade_bars = np.nonzero(trade_flags(buy, sell))
+
+        # Matrices (row, trade number) of trade bars and prices
+        counts = np.bincount(trade_rows, minlength=rows)
+        numbers = np.arange(len(trade_rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        max_count = counts.max() if rows else 0
+        bars = np.zeros((rows, max_count), dtype=np.intp)
+        bars[trade_rows, numbers] = trade_bars
+        trade_price = np.full((rows, max_count), np.nan)
+        trade_price[trade_rows, numbers] = price_array[trade_bars]
+
+        # Simulate trades. Sums are recorded as the ledger keeps them:
+        # before buy and after sell
+        sum_usd = np.full(rows, float(self.startsum))
+        sum_btc = np.zeros(rows)
+        trade_sum = np.zeros((rows, max_count))
+        end_sum = np.full(rows, np.nan)
+        executed = np.zeros(rows, dtype=np.intp)
+        active = np.ones(rows, dtype=bool)
+        for number in range(max_count):
+            price = trade_price[:, number]
+            if number % 2 == 0:
+                # Rows having this trade and something to trade with
+                active &= (counts > number) & (sum_usd > 0)
+                trade_sum[:, number] = sum_usd
+                bought = sum_usd / price
+                bought -= bought * self.fee
+                np.copyto(sum_btc, bought, where=active)
+                sum_usd[active] = 0
+            else:
+                active &= (counts > number) & (sum_btc > 0)
+                sold = sum_btc * price
+                sold -= sold * self.fee
+                np.copyto(sum_usd, sold, where=active)
+                sum_btc[active] = 0
+                np.copyto(end_sum, sum_usd, where=active)
+                trade_sum[:, number] = sum_usd
+            executed += active
+
+        return (bars, trade_sum, executed, end_sum)
+
+    # Simulate trades of pair being tested on signal arrays
+    def follow_signals(self, buy, sell, prices, holding=False, offset=0):
+        """
+        holding - if pair holds currency 2 at start
+        offset - bar index of the first signal, for the ledger
+        Returns sum after the last sell, None if nothing was sold
+        """
+        end_sum = None
+        for number, index in enumerate(trade_indices(buy, sell, holding).tolist()):
+            # Buy is made with currency 1, sell with currency 2
+            side = (number + holding) % 2
+            # Nothing left to trade with
+            if not self.current_sum[side] > 0:
+                break
+            action = 'sell' if side else 'buy'
+            self.trade(action, offset + index, prices[index])
+            if action == 'sell':
+                end_sum = self.current_sum[0]
+        return end_sum
+
+    # Continue backtest of all tested pairs on new bars
+    def resume(self, av_obj, data_obj, offset, sar_trend, buy_allowed):
+        """
+        Simulation state of every pair is taken from its ledger, see pair_state().
+        Ledgers and results of pairs are updated as if all bars were tested at once.
+
+        av_obj - averages of new bars, see AveragesView
+        data_obj - all bars, new bars start at offset
+        sar_trend - SAR trend of new bars
+        buy_allowed - boolean matrix of shape of self.results, if fast MA of
+                      pair has been below slow (algorithms #1 and #2). Updated in place
+        """
+        self.avdata = av_obj
+        self.data = data_obj
+        prices = self.data.price[offset:].tolist()
+        sar_trend = np.asarray(sar_trend)
+
+        for ma_index, ma in enumerate(self.ma_types):
+            print ("Resuming %s '%s' on %d bars" % (self.resolution, ma, len(prices)))
 
+            prog = Progress(len(self.pairs))
+
+            pending = {}
+            for av_pair in self.pairs:
+                for period in av_pair:
+                    pending[period] = pending.get(period, 0) + 1
+
+            for pair_number, av_pair in enumerate(self.pairs):
+                fast_period, slow_period = av_pair
+                fast_ma = np.asarray(self.avdata.ma[ma][fast_period])
+                slow_ma = np.asarray(self.avdata.ma[ma][slow_period])
+                allowed = buy_allowed[ma_index, fast_period, slow_period]
+
+                ledger = self.ledger[ma][av_pair]
+                holding = self.pair_state(ma, av_pair)
+                self.pair_trades = ledger_trades(ledger)
+                result = self.result(ma, av_pair)
+                self.transactions = int(result['transactions'])
+
+                buy, sell = self.signals(fast_ma, slow_ma, sar_trend, allowed)
+                end_sum = self.follow_signals(buy, sell, prices, holding, offset)
+                buy_allowed[ma_index, fast_period, slow_period] = allowed or bool((fast_ma < slow_ma).any())
+
+                trades = np.array(self.pair_trades, dtype=[('bar', np.int64), ('price', np.float64), ('sum', np.float64)])
+                self.ledger[ma][av_pair] = trade_ledger(trades['bar'], trades['price'], trades['sum'])
+                result['transactions'] = self.transactions
+                if end_sum is not None:
+                    result['end_sum'] = end_sum
+                result['profit'] = (result['end_sum'] - self.startsum) * 100 / self.startsum
+                self.stats(ma, av_pair)
+
+                self.release_pair(ma, av_pair, pending)
+
+                prog.show(pair_number)
+
+            self.summarize(ma)
+
+    # Simulation state of pair after the last trade of its ledger
+    def pair_state(self, ma, av_pair):
+        """ Sets self.current_sum the way buy_sell_sim() left it, returns if currency 2 is held """
+        ledger = self.ledger[ma][av_pair]
+        self.current_sum = [float(self.startsum), 0.]
+        if len(ledger) == 0:
+            return False
+
+        last = ledger[-1]
+        if last['exit'] >= 0:
+            self.current_sum[0] = float(last['exit_sum'])
+            return False
+        self.current_sum[0] = float(last['entry_sum'])
+        self.buy_sell_sim(float(last['entry_price']), 'buy', self.current_sum)
+        return True
+
+    # Simulate trade of pair being tested and record it
+    def trade(self, action, index, price):
+        if action == 'buy':
+            # Sum before buying goes to the ledger
+            trade_sum = self.current_sum[0]
+            self.buy_sell_sim(price, 'buy', self.current_sum)
+        else:
+            # Sum after selling goes to the ledger
+            self.buy_sell_sim(price, 'sell', self.current_sum)
+            trade_sum = self.current_sum[0]
+        self.pair_trades.append((index, price, trade_sum))
+        self.transactions += 1
+
+    # Signal arrays of decision() for all bars at once
+    def signals(self, fast_ma, slow_ma, sar_trend, buy_allowed=False):
+        """
+        Returns boolean arrays of bars where decision() would approve
+        buy and sell. Buy of algorithms #1 and #2 is allowed only after
+        fast MA has been below slow, as buy_allowed in decision(),
+        or from the start if buy_allowed
+        """
+        fast_ma = np.asarray(fast_ma)
+        slow_ma = np.asarray(slow_ma)
+
+        # Bars are along the last axis, so matrices of many pairs work as well
+        if self.algorithm == 1 or self.algorithm == 2:
+            below = fast_ma < slow_ma
+            allowed = np.logical_or.accumulate(below, axis=-1)
+            if buy_allowed:
+                allowed[...] = True
+            buy = (fast_ma > slow_ma) & allowed
+            if self.algorithm == 1:
+                sell = below
+            else:
+                sell = below & (np.asarray(sar_trend) < 0)
+            return (buy, sell)
+
+        if self.algorithm == 3:
+            # Same expression as in decision() to get the same rounding
+            ma_dif = 100 * (fast_ma - slow_ma) / ((fast_ma + slow_ma)/2)
+            return (ma_dif > self.t_buy, ma_dif < -self.t_sell)
+
+        # Unknown algorithm never trades
+        no_signal = np.zeros(fast_ma.shape, dtype=bool)
+        return (no_signal, no_signal)
 
     # Decision on whether to buy or sell
     def decision(self, action, fast_ma, slow_ma, sar_trend):
@@ -639,8 +1657,10 @@ class AveragesAnalytics(object):
             # Set currency 2 amount to 0
             current_sum[1] = 0
 
-    # Write stats for each pair
-    """
+    # Stats of pair from its ledger
+    def stats(self, ma, av_pair):
+        """
+        Sets in results of pair:
             biggest_win
             biggest_loss
             won_trades_sum
@@ -652,113 +1672,53 @@ class AveragesAnalytics(object):
             max_consecutive_profit
             max_consecutive_loss
 
-            last_buy_trade
-            last_sell_trade
-
-            """
-
-    def stats(self, ma, av_pair, action, sum, time, price):
-        date = dt_date(time)
+        Streaks are runs of wins or losses. Streak profit is the change
+        of sum from its first buy to the first buy of the next streak,
+        so the last streak does not count.
+        """
+        ledger = self.ledger[ma][av_pair]
+        result = self.result(ma, av_pair)
         # Additional printing for these settings
         debug_ma = 'exp'
         debug_pair = (18, 26)
 
-        # If buying
-        if action == "buy":
-            # Simply remember this trade
-            self.last_buy_trade[ma][av_pair] = {"sum": sum}
-            # Debug
-            if ma == debug_ma and av_pair == debug_pair:
-                print(date, "Buy for %.2f" % price)
-
-        # If selling
-        elif action == "sell":
-            # Calculate profit in percent for this one trade
-            before_buy_sum = self.last_buy_trade[ma][av_pair]['sum']
-            profit = ((sum - before_buy_sum) / before_buy_sum) * 100
-
-            # If this is the first sell, set sequence start sum to the initial sum
-            if self.last_sell_trade[ma][av_pair]["result"] == "":
-                self.last_sell_trade[ma][av_pair]["current_seq_start_sum"] = before_buy_sum
-
-            # If win
-            if profit > 0:
-                # Write if this is the biggest win
-                if profit > self.biggest_win[ma][av_pair]:
-                    self.biggest_win[ma][av_pair] = profit
-
-                # Summarize total won sum
-                self.won_trades_sum[ma][av_pair] += sum - before_buy_sum
-                # Increment total winning trades count
-                self.won_trades_num[ma][av_pair] += 1
-
-                # If last sell was a loss
-                if self.last_sell_trade[ma][av_pair]["result"] == "loss":
-                    # Calculate last loss sequence loss in percent
-                    loss_start_sum = self.last_sell_trade[ma][av_pair]["current_seq_start_sum"]
-                    last_sequence_loss = ((before_buy_sum - loss_start_sum) / loss_start_sum) * 100
-                    # If it's worse than all-time sequential loss - write
-                    if last_sequence_loss < self.max_consecutive_loss[ma][av_pair]:
-                        self.max_consecutive_loss[ma][av_pair] = last_sequence_loss
-
-                    # Zeroize sequence count
-                    self.last_sell_trade[ma][av_pair]["current_seq_count"] = 0
-                    # And reset start sum
-                    self.last_sell_trade[ma][av_pair]["current_seq_start_sum"] = before_buy_sum
-
-                # Increment consecutive wins count
-                self.last_sell_trade[ma][av_pair]["current_seq_count"] += 1
-
-                # Update max win sequence count if current one is bigger
-                if self.last_sell_trade[ma][av_pair]["current_seq_count"] > self.max_consecutive_wins[ma][av_pair]:
-                    self.max_consecutive_wins[ma][av_pair] = self.last_sell_trade[ma][av_pair]["current_seq_count"]
-
-                # Update last trade result
-                self.last_sell_trade[ma][av_pair]["result"] = "win"
-
-            # If loss
-            else:
-                # Write if this is the worst loss
-                if profit < self.biggest_loss[ma][av_pair]:
-                    self.biggest_loss[ma][av_pair] = profit
-
-                # Summarize total lost sum
-                self.lost_trades_sum[ma][av_pair] += sum - before_buy_sum
-                # Increment total losing trades count
-                self.lost_trades_num[ma][av_pair] += 1
-
-                # If last sell was a win
-                if self.last_sell_trade[ma][av_pair]["result"] == "win":
-                    # Calculate last win sequence profit in percent
-                    win_start_sum = self.last_sell_trade[ma][av_pair]["current_seq_start_sum"]
-                    last_sequence_profit = ((before_buy_sum - win_start_sum) / win_start_sum) * 100
-                    # If it's better than all-time sequential win - write
-                    if last_sequence_profit > self.max_consecutive_profit[ma][av_pair]:
-                        self.max_consecutive_profit[ma][av_pair] = last_sequence_profit
-
-                    # Zeroize sequence count
-                    self.last_sell_trade[ma][av_pair]["current_seq_count"] = 0
-                    # And reset start sum
-                    self.last_sell_trade[ma][av_pair]["current_seq_start_sum"] = before_buy_sum
-
-                # Increment consecutive loss count
-                self.last_sell_trade[ma][av_pair]["current_seq_count"] += 1
-
-                # Update max loss sequence count if current one is bigger
-                if self.last_sell_trade[ma][av_pair]["current_seq_count"] > self.max_consecutive_losts[ma][av_pair]:
-                    self.max_consecutive_losts[ma][av_pair] = self.last_sell_trade[ma][av_pair]["current_seq_count"]
-
-                # Update last trade result
-                self.last_sell_trade[ma][av_pair]["result"] = "loss"
-
-            # Win/loss if end
-
-            # Debug
-            if ma == debug_ma and av_pair == debug_pair:
-                print(date, "Sell for %.2f" % price)
-                print(date, "%s Sum: %.2f profit: %.2f%%" % (self.last_sell_trade[ma][av_pair], sum, profit))
-
-        # Buy/sell if end
+        closed = ledger[ledger['exit'] >= 0]
+        before_buy_sum = closed['entry_sum']
+        trade_sum = closed['exit_sum'] - before_buy_sum
+        # Profit in percent of every trade
+        profit = (trade_sum / before_buy_sum) * 100
+        won = profit > 0
+
+        result['biggest_win'] = max_or_zero(profit[won])
+        result['biggest_loss'] = min_or_zero(profit)
+        # Sums are accumulated in order of trades
+        result['won_trades_sum'] = float(np.cumsum(trade_sum[won])[-1]) if won.any() else 0
+        result['lost_trades_sum'] = float(np.cumsum(trade_sum[~won])[-1]) if (~won).any() else 0
+        result['won_trades_num'] = int(won.sum())
+        result['lost_trades_num'] = int(len(won) - won.sum())
+
+        # Runs of wins and losses
+        run_starts = np.flatnonzero(np.concatenate(([True], won[1:] != won[:-1]))) if len(won) else np.empty(0, dtype=np.intp)
+        run_lengths = np.diff(np.append(run_starts, len(won)))
+        run_won = won[run_starts]
+        result['max_consecutive_wins'] = int(run_lengths[run_won].max()) if run_won.any() else 0
+        result['max_consecutive_losts'] = int(run_lengths[~run_won].max()) if (~run_won).any() else 0
+
+        # Profit of every finished streak
+        start_sum = before_buy_sum[run_starts[:-1]]
+        streak_profit = ((before_buy_sum[run_starts[1:]] - start_sum) / start_sum) * 100
+        result['max_consecutive_profit'] = max_or_zero(streak_profit[run_won[:-1]])
+        result['max_consecutive_loss'] = min_or_zero(streak_profit[~run_won[:-1]])
+
+        # Debug
+        if ma == debug_ma and av_pair == debug_pair:
+            times = self.data.time
+            for trade in ledger:
+                print(dt_date(int(times[trade['entry']])), "Buy for %.2f" % trade['entry_price'])
+                if trade['exit'] >= 0:
+                    print(dt_date(int(times[trade['exit']])), "Sell for %.2f" % trade['exit_price'])
+                    print(dt_date(int(times[trade['exit']])), "Sum: %.2f profit: %.2f%%"
+                          % (trade['exit_sum'], (trade['exit_sum'] - trade['entry_sum']) / trade['entry_sum'] * 100))
 
     # stats() end
 
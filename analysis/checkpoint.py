@@ -0,0 +1,247 @@
+import numpy as np
+
+# Own package imports
+from .analysis import Data, AveragesAnalytics, AveragesView, LEDGER_DTYPE, ema, ema_block, ema_window
+from . import incremental
+
+"""
+Checkpoints of backtest runs
+
+Checkpoint keeps everything needed to continue a run on ticks appended
+after it: bars and the interval in progress, tails of averages and SAR,
+results, ledgers and simulation state of every pair. Continued run has
+the same results as backtest of all data, but only new bars are tested.
+"""
+
+
+class AveragesTail(object):
+    """
+    Last prices and state of MovingAverages calculation. Averages of new
+    bars calculated from it are the same as averages of all bars.
+
+    Structure:
+        self.start - index of the first tail price in all prices
+        self.price - prices from start
+        self.csum - cumulative sum of all prices from start, see sma()
+        self.carry - for every period, exponential average before the
+                     last ema() block border, NaN if border is the first price
+    """
+    def __init__(self, av_periods, ema_type, start, price, csum, carry):
+        self.periods = list(av_periods)
+        self.ema_type = ema_type
+        self.start = int(start)
+        self.price = np.asarray(price, dtype=np.float64)
+        self.csum = np.asarray(csum, dtype=np.float64)
+        self.carry = np.asarray(carry, dtype=np.float64)
+
+    # Exponential averages are recalculated from the last block border
+    def block_starts(self, datalen):
+        return [datalen // ema_block(period) * ema_block(period) for period in self.periods]
+
+    @classmethod
+    def from_prices(cls, price, av_periods, ema_type):
+        """ price - all prices averages are calculated of, see MovingAverages.price """
+        price = np.asarray(price, dtype=np.float64)
+        tail = cls(av_periods, ema_type, 0, price, np.cumsum(price, dtype=np.float64), [])
+        return tail.tail(len(price), price, tail.csum, None)
+
+    def tail(self, datalen, price, csum, averages):
+        """
+        Tail of the last datalen prices of price and csum, which start at self.start
+        averages - exponential averages of every period from its block border, see extend()
+        """
+        starts = self.block_starts(datalen)
+        start = max(min(starts + [datalen - max(self.periods)]), 0)
+
+        carry = np.full(len(self.periods), np.nan)
+        if self.ema_type == 'recursive':
+            old_starts = self.block_starts(self.start + len(self.price))
+            for row, period in enumerate(self.periods):
+                block_start = starts[row]
+                if block_start == 0:
+                    continue
+                if averages is None:
+                    carry[row] = ema(price[:block_start], period)[-1]
+                elif block_start == old_starts[row]:
+                    carry[row] = self.carry[row]
+                else:
+                    carry[row] = averages[row][block_start - 1 - old_starts[row]]
+
+        offset = start - self.start
+        return AveragesTail(self.periods, self.ema_type, start, price[offset:].copy(), csum[offset:].copy(), carry)
+
+    def extend(self, new_price, ma_types):
+        """ Returns dictionary of MA type: matrix of averages of new prices, shape (len(periods), len(new_price)),
+            and tail after new prices """
+        new_price = np.asarray(new_price, dtype=np.float64)
+        count = len(self.price)
+        price = np.concatenate((self.price, new_price))
+        # Cumulative sum goes on from the last value the way np.cumsum() adds
+        csum = np.concatenate((self.csum, np.cumsum(np.concatenate((self.csum[-1:], new_price)))[1:]))
+
+        matrices = {}
+        if 'simple' in ma_types:
+            # Same operations as sma()
+            matrices['simple'] = np.array([(csum[count:] - csum[count - period:len(csum) - period]) / period
+                                           for period in self.periods]).reshape(len(self.periods), len(new_price))
+
+        averages = None
+        if self.ema_type == 'recursive':
+            averages = []
+            for row, (period, block_start) in enumerate(zip(self.periods, self.block_starts(self.start + count))):
+                offset = block_start - self.start
+                initial = None if np.isnan(self.carry[row]) else self.carry[row]
+                averages.append(ema(price[offset:], period, initial))
+            if 'exp' in ma_types:
+                matrices['exp'] = np.array([values[len(values) - len(new_price):] for values in averages]).reshape(len(self.periods), len(new_price))
+        elif 'exp' in ma_types:
+            matrices['exp'] = np.array([ema_window(price, period)[count:] for period in self.periods]).reshape(len(self.periods), len(new_price))
+
+        return (matrices, self.tail(self.start + len(price), price, csum, averages))
+
+
+class Checkpoint(object):
+    """
+    Structure:
+        self.analytics - AveragesAnalytics with results and ledgers of all tested pairs
+        self.data - Data object of all bars, extended by rows of source after self.next_row
+        self.bars - number of bars tested
+        self.averages - AveragesTail after tested bars
+        self.sar - incremental.SAR after tested bars
+        self.buy_allowed - see AveragesAnalytics.resume()
+        self.settings - dictionary of threshold_buy, threshold_sell, starttime and lookback time of run
+        self.last_time - time of the last tick read
+        self.next_row - number of source row after the last one read, see tickfile.read_rows()
+    """
+    def __init__(self, analytics, data_obj, averages, sar, buy_allowed, settings, last_time, next_row):
+        self.analytics = analytics
+        self.data = data_obj
+        self.bars = len(data_obj)
+        self.averages = averages
+        self.sar = sar
+        self.buy_allowed = buy_allowed
+        self.settings = settings
+        self.last_time = int(last_time)
+        self.next_row = int(next_row)
+
+    @classmethod
+    def create(cls, analytics, av_obj, data_obj, sar_obj, af_inc, af_max, settings, last_time, next_row):
+        """
+        Checkpoint of run just tested by analytics.backtest()
+        sar_obj - SAR-like object the run was tested with, of af_inc and af_max parameters
+        """
+        # Pairs which bought something were allowed to buy
+        buy_allowed = np.zeros(analytics.results.shape, dtype=bool)
+        for ma_index, ma in enumerate(analytics.ma_types):
+            for fast_period, slow_period in analytics.pairs:
+                if len(analytics.ledger[ma][(fast_period, slow_period)]):
+                    allowed = True
+                else:
+                    allowed = bool((av_obj.ma[ma][fast_period] < av_obj.ma[ma][slow_period]).any())
+                buy_allowed[ma_index, fast_period, slow_period] = allowed
+            for period in av_obj.periods:
+                av_obj.release(ma, period)
+
+        sar = incremental.SAR(af_inc, af_max)
+        sar.extend(data_obj)
+        assert sar.trend == sar_obj.trend[-1]
+
+        # Own copy of data, it is extended later
+        data_copy = Data(data_obj.resolution)
+        data_copy.load_arrays(data_obj.arrays())
+        data_copy.load_interval_state(data_obj.interval_state())
+
+        averages = AveragesTail.from_prices(av_obj.price, av_obj.periods, av_obj.ema_type)
+        return cls(analytics, data_copy, averages, sar, buy_allowed, settings, last_time, next_row)
+
+    def extend(self, time, price, next_row):
+        """
+        Add rows of source read after self.next_row to data, whatever their
+        time is: trades of the last second and late ones are taken the same
+        way backtest of all data takes them.
+        next_row - number of source row after the given ones
+        """
+        time = np.asarray(time, dtype=np.int64)
+        price = np.asarray(price, dtype=np.float64)
+        if len(time):
+            self.last_time = int(time[-1])
+        # Ticks before lookback time are not taken by backtest.py either
+        in_range = time >= self.settings['lookback']
+        self.data.extend(time[in_range], price[in_range])
+        self.next_row = int(next_row)
+
+    def resume(self):
+        """ Test new bars of data, analytics and checkpoint state are updated """
+        analytics = self.analytics
+        new_bars = len(self.data) - self.bars
+        print ("%s: %d new bars" % (analytics.resolution, new_bars))
+        if new_bars == 0:
+            for ma in analytics.ma_types:
+                analytics.summarize(ma)
+            return
+
+        matrices, self.averages = self.averages.extend(self.data.price[self.bars:], analytics.ma_types)
+
+        trend = np.empty(new_bars, dtype=np.int16)
+        for index, (high, low) in enumerate(zip(self.data.high[self.bars:].tolist(), self.data.low[self.bars:].tolist())):
+            self.sar.add(high, low, True)
+            trend[index] = self.sar.trend
+
+        analytics.resume(AveragesView(matrices, self.averages.periods), self.data, self.bars, trend, self.buy_allowed)
+        self.bars = len(self.data)
+
+    def save(self, path):
+        analytics = self.analytics
+        # Ledgers of all pairs one after another, in order of MA types and pairs
+        ledgers = [analytics.ledger[ma][av_pair] for ma in analytics.ma_types for av_pair in analytics.pairs]
+        interval = dict(('interval_' + key, value) for key, value in self.data.interval_state().items())
+        settings = dict(('setting_' + key, value) for key, value in self.settings.items())
+        arrays = analytics.arrays()
+        arrays.update(interval, **settings)
+        np.savez_compressed(path,
+                            ledger=np.concatenate(ledgers) if ledgers else np.empty(0, dtype=LEDGER_DTYPE),
+                            ledger_lengths=np.array([len(ledger) for ledger in ledgers], dtype=np.int64),
+                            buy_allowed=self.buy_allowed, last_time=self.last_time, next_row=self.next_row,
+                            data_resolution=self.data.resolution, data_time=self.data.time, data_price=self.data.price,
+                            data_high=self.data.high, data_low=self.data.low,
+                            ma_start=self.averages.start, ma_price=self.averages.price, ma_csum=self.averages.csum,
+                            ma_carry=self.averages.carry, ma_periods=np.array(self.averages.periods), ema_type=self.averages.ema_type,
+                            sar_params=(self.sar.af_inc, self.sar.af_max), sar_count=self.sar.count,
+                            sar_last=self.sar.last, sar_state=self.sar.state, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            if 'next_row' not in saved.files:
+                raise ValueError("%s is made by older version, run backtest.py --checkpoint again" % path)
+            analytics = AveragesAnalytics.from_arrays(saved)
+            settings = dict((key[8:], saved[key].item()) for key in saved.files if key.startswith('setting_'))
+            analytics.t_buy = float(settings['threshold_buy'])
+            analytics.t_sell = float(settings['threshold_sell'])
+
+            ledger = saved['ledger']
+            bounds = np.cumsum(saved['ledger_lengths'])
+            number = 0
+            for ma in analytics.ma_types:
+                analytics.ledger[ma] = {}
+                for av_pair in analytics.pairs:
+                    analytics.ledger[ma][av_pair] = ledger[bounds[number] - saved['ledger_lengths'][number]:bounds[number]]
+                    number += 1
+
+            data_obj = Data(int(saved['data_resolution']))
+            data_obj.load_arrays({'time': saved['data_time'], 'price': saved['data_price'],
+                                  'high': saved['data_high'], 'low': saved['data_low']})
+            data_obj.load_interval_state(dict((key[9:], saved[key].item()) for key in saved.files if key.startswith('interval_')))
+
+            averages = AveragesTail(saved['ma_periods'].tolist(), str(saved['ema_type']), int(saved['ma_start']),
+                                    saved['ma_price'], saved['ma_csum'], saved['ma_carry'])
+
+            af_inc, af_max = saved['sar_params'].tolist()
+            sar = incremental.SAR(af_inc, af_max)
+            sar.count = int(saved['sar_count'])
+            sar.last = tuple(saved['sar_last'].tolist())
+            trend, sar_value, xp, af = saved['sar_state'].tolist()
+            sar.state = (int(trend), sar_value, xp, af)
+
+            return cls(analytics, data_obj, averages, sar, np.array(saved['buy_allowed']), settings,
+                       int(saved['last_time']), int(saved['next_row']))
@@ -0,0 +1,198 @@
+import math
+import collections
+
+import numpy as np
+
+# Own package imports
+from .analysis import ema, ema_window
+
+"""
+Indicators updated in constant time for realtime use
+
+Every indicator is started from all data of Data object by extend()
+and then follows Data.update(): update(data_obj, new_element) is called
+after every update which changed data, new_element being its result.
+New element moves indicator one step forward, otherwise indicator value
+of the last element is recalculated from the saved state of the previous one.
+"""
+
+
+# Make incremental moving average for MovingAverages type and period
+def average(ma_type, period, ema_type='recursive'):
+    if ma_type == 'simple':
+        return SMA(period)
+    if ema_type == 'recursive':
+        return EMA(period)
+    if ema_type == 'window':
+        return WindowEMA(period)
+    raise ValueError("Unknown EMA type %s" % ema_type)
+
+
+class SMA(object):
+    """ Simple moving average, see analysis.sma() """
+    def __init__(self, period):
+        self.period = period
+        self.window = collections.deque(maxlen=period)
+        self.sum = 0.
+        self.updates = 0
+        self.value = None
+
+    def extend(self, data_obj):
+        self.window.clear()
+        self.window.extend(data_obj.price[-self.period:].tolist())
+        self.sum = math.fsum(self.window)
+        self.value = self.sum / self.period if self.window else None
+
+    def update(self, data_obj, new_element):
+        price = float(data_obj.price[-1])
+        if new_element or not self.window:
+            if len(self.window) == self.period:
+                self.sum -= self.window[0]
+            self.window.append(price)
+            self.sum += price
+        else:
+            self.sum += price - self.window[-1]
+            self.window[-1] = price
+
+        # Sum is recalculated once in a period so rounding errors don't pile up
+        self.updates += 1
+        if self.updates % self.period == 0:
+            self.sum = math.fsum(self.window)
+
+        self.value = self.sum / self.period
+
+
+class EMA(object):
+    """ Recursive exponential moving average, see analysis.ema() """
+    def __init__(self, period):
+        self.period = period
+        self.alpha = 2. / (period + 1)
+        self.decay = 1 - self.alpha
+        # Average of the element before the last one
+        self.previous = None
+        self.value = None
+
+    def extend(self, data_obj):
+        values = ema(data_obj.price, self.period)
+        if len(values) == 0:
+            self.previous = self.value = None
+            return
+        self.value = float(values[-1])
+        # First average is the price itself
+        self.previous = float(values[-2]) if len(values) > 1 else self.value
+
+    def update(self, data_obj, new_element):
+        price = float(data_obj.price[-1])
+        if self.value is None:
+            self.previous = price
+        elif new_element:
+            self.previous = self.value
+        self.value = self.alpha * price + self.decay * self.previous
+
+
+class WindowEMA(object):
+    """
+    Exponentially weighted window, see analysis.ema_window().
+    Takes time proportional to period
+    """
+    def __init__(self, period):
+        self.period = period
+        self.window = collections.deque(maxlen=period)
+        # Weights of the newest price first
+        self.weights = np.exp(np.linspace(-1., 0., period))
+        self.weights /= self.weights.sum()
+        self.weights = self.weights[::-1]
+        self.value = None
+
+    def extend(self, data_obj):
+        self.window.clear()
+        self.window.extend(data_obj.price[-self.period:].tolist())
+        self.value = float(ema_window(np.asarray(self.window), self.period)[-1]) if self.window else None
+
+    def update(self, data_obj, new_element):
+        price = float(data_obj.price[-1])
+        if new_element or not self.window:
+            self.window.append(price)
+        else:
+            self.window[-1] = price
+        newest_first = list(reversed(self.window))
+        self.value = float(np.dot(self.weights[:len(newest_first)], newest_first))
+
+
+class SAR(object):
+    """
+    Parabolic SAR, see analysis.SAR.
+    State is (trend, sar, extreme point, acceleration factor)
+    """
+    def __init__(self, af_inc=0.02, af_max=0.2):
+        self.af_inc = af_inc
+        self.af_max = af_max
+        self.count = 0
+        # High and low of the last and previous elements
+        self.last = None
+        self.previous = None
+        # State after previous and last elements
+        self.before = None
+        self.state = None
+
+    @property
+    def trend(self):
+        return self.state[0] if self.state else None
+
+    @property
+    def sar(self):
+        return self.state[1] if self.state else None
+
+    def initial(self, first, second):
+        """ State of the first element, trend depends on the second one """
+        if second[0] > first[0] or first[1] < second[1]:
+            return (1, first[1], first[0], self.af_inc)
+        return (-1, first[0], first[1], self.af_inc)
+
+    def step(self, state, high, low, prev_high, prev_low):
+        """ Same calculation as in analysis.SAR loop """
+        trend, sar, xp, af = state
+        if trend > 0:
+            if high > xp:
+                xp = high
+                af = min(self.af_max, af + self.af_inc)
+            current_sar = sar + af * (xp - sar)
+            # SAR can't be higher than previous low
+            if current_sar > prev_low:
+                current_sar = prev_low
+            if low < current_sar:
+                return (-1, xp, low, self.af_inc)
+            return (1, current_sar, xp, af)
+        else:
+            if low < xp:
+                xp = low
+                af = min(self.af_max, af + self.af_inc)
+            current_sar = sar + af * (xp - sar)
+            # SAR can't be lower than previous high
+            if current_sar < prev_high:
+                current_sar = prev_high
+            if high > current_sar:
+                return (1, xp, high, self.af_inc)
+            return (-1, current_sar, xp, af)
+
+    def add(self, high, low, new_element):
+        if new_element or self.count == 0:
+            self.count += 1
+            self.previous = self.last
+            self.before = self.state
+        self.last = (high, low)
+
+        if self.count == 1:
+            self.state = None
+            return
+        if self.count == 2:
+            self.before = self.initial(self.previous, self.last)
+        self.state = self.step(self.before, high, low, *self.previous)
+
+    def extend(self, data_obj):
+        self.__init__(self.af_inc, self.af_max)
+        for high, low in zip(data_obj.high.tolist(), data_obj.low.tolist()):
+            self.add(high, low, True)
+
+    def update(self, data_obj, new_element):
+        self.add(float(data_obj.high[-1]), float(data_obj.low[-1]), new_element)
@@ -0,0 +1,226 @@
+import os
+import sys
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Own package imports
+from .analysis import AveragesAnalytics, AveragesView, DataView, SARSeries
+
+"""
+Parallel backtest
+
+Work is split into shards of (run, MA type, block of pairs) which are
+tested by a pool of processes. Bars, SAR trend and averages matrices are
+put into shared memory once, workers map them instead of getting copies.
+Results of shards are merged into one AveragesAnalytics object per run.
+
+Walk-forward optimization shares arrays the same way, its work is split
+into windows of (run, MA type, in-sample and out-of-sample bars).
+"""
+
+# Shards per process for every run and MA type, to keep all processes busy till the end
+SHARDS_PER_JOB = 4
+
+
+class SharedArrays(object):
+    """ Arrays copied into shared memory blocks, one block per array """
+    def __init__(self, arrays):
+        self.blocks = []
+        self.spec = {}
+        for name, values in arrays.items():
+            values = np.ascontiguousarray(values)
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+            self.blocks.append(block)
+            # Everything a worker needs to map the array
+            self.spec[name] = (block.name, values.shape, values.dtype.str)
+
+    def unlink(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+# Blocks mapped by this worker process, block name: SharedMemory
+attached = {}
+
+
+# Map arrays of SharedArrays.spec
+def attach(spec):
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        if block_name not in attached:
+            attached[block_name] = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=attached[block_name].buf)
+    return arrays
+
+
+# Silence progress output of workers
+def init_worker():
+    sys.stdout = open(os.devnull, 'w')
+
+
+# Analytics of pairs tested on bars[first:last] of shared arrays
+def window_backtest(run_name, arrays, ma, periods, av_periods, av_pairs, first, last, fee, algorithm,
+                    threshold_buy, threshold_sell, engine, grid_memory):
+    sar_obj = SARSeries()
+    sar_obj.trend = arrays['trend'][first:last]
+
+    analytics = AveragesAnalytics(run_name, fee, algorithm)
+    analytics.backtest(AveragesView({ma: arrays[ma][:, first:last]}, periods),
+                       DataView(arrays['time'][first:last], arrays['price'][first:last]),
+                       av_periods, av_pairs, sar_obj, threshold_buy, threshold_sell,
+                       (ma,), engine, grid_memory)
+    return analytics
+
+
+# Backtest of one shard
+def backtest_shard(task):
+    """ Returns run name, MA type, pairs and results of AveragesAnalytics.pair_results() """
+    (run_name, spec, ma, periods, av_periods, av_pairs, fee, algorithm,
+     threshold_buy, threshold_sell, engine, grid_memory) = task
+    arrays = attach(spec)
+
+    analytics = window_backtest(run_name, arrays, ma, periods, av_periods, av_pairs, None, None, fee, algorithm,
+                                threshold_buy, threshold_sell, engine, grid_memory)
+    return (run_name, ma, av_pairs, analytics.pair_results(ma, av_pairs))
+
+
+# Walk-forward step of one window
+def walk_forward_window(task):
+    """
+    Returns run name, window, MA type, the best in-sample pair (None if no pair sold anything),
+    its in-sample and out-of-sample profit
+    """
+    (run_name, spec, ma, periods, av_periods, av_pairs, window, bars, fee, algorithm,
+     threshold_buy, threshold_sell, engine, grid_memory) = task
+    in_first, out_first, out_last = bars
+    arrays = attach(spec)
+
+    in_sample = window_backtest(run_name, arrays, ma, periods, av_periods, av_pairs, in_first, out_first, fee, algorithm,
+                                threshold_buy, threshold_sell, engine, grid_memory)
+    profit = np.ma.masked_invalid(in_sample.matrix('profit', ma))
+    if profit.count() == 0:
+        return (run_name, window, ma, None, np.nan, np.nan)
+    best = tuple(int(period) for period in np.unravel_index(profit.argmax(), profit.shape))
+
+    out_sample = window_backtest(run_name, arrays, ma, periods, av_periods, [best], out_first, out_last, fee, algorithm,
+                                 threshold_buy, threshold_sell, engine, grid_memory)
+    return (run_name, window, ma, best, float(profit[best]), float(out_sample.result(ma, best)['profit']))
+
+
+# Put bars, SAR trend and averages of runs into shared memory
+def share_runs(runs, periods, ma_types, shared):
+    """
+    Only given periods of averages are calculated and shared.
+    Created SharedArrays are appended to shared list, to be unlinked by caller.
+    Returns dictionary of run name: spec of its arrays
+    """
+    # Runs of the same resolution share averages
+    shared_averages = {}
+    specs = {}
+    for run_name, (av_obj, data_obj, sar_obj) in runs.items():
+        if id(av_obj) not in shared_averages:
+            matrices = {}
+            for ma in ma_types:
+                matrices[ma] = av_obj.matrix(ma, periods)
+                for period in periods:
+                    av_obj.release(ma, period)
+            shared_averages[id(av_obj)] = SharedArrays(matrices)
+            shared.append(shared_averages[id(av_obj)])
+
+        bars = SharedArrays({'time': data_obj.time, 'price': data_obj.price, 'trend': sar_obj.trend})
+        shared.append(bars)
+        specs[run_name] = dict(shared_averages[id(av_obj)].spec, **bars.spec)
+    return specs
+
+
+def backtest(runs, jobs, fee, algorithm, av_periods, av_pairs, threshold_buy, threshold_sell,
+             ma_types=('simple', 'exp'), engine='vector', grid_memory=256*1024*1024):
+    """
+    Same as AveragesAnalytics.backtest() of every run by jobs processes.
+
+    runs - dictionary of run name: (MovingAverages, Data, SAR-like object)
+    Returns dictionary of run name: AveragesAnalytics
+    """
+    # Only periods of tested pairs are calculated and shared
+    periods = sorted(set(period for av_pair in av_pairs for period in av_pair))
+    shard_size = max(-(-len(av_pairs) // (jobs * SHARDS_PER_JOB)), 1)
+
+    shared = []
+    tasks = []
+    try:
+        specs = share_runs(runs, periods, ma_types, shared)
+        for run_name in runs.keys():
+            for ma in ma_types:
+                for first in range(0, len(av_pairs), shard_size):
+                    tasks.append((run_name, specs[run_name], ma, periods, av_periods, av_pairs[first:first + shard_size],
+                                  fee, algorithm, threshold_buy, threshold_sell, engine, grid_memory))
+
+        analytics = {}
+        for run_name in runs.keys():
+            analytics[run_name] = AveragesAnalytics(run_name, fee, algorithm)
+            analytics[run_name].init_results(ma_types, av_periods, av_pairs)
+
+        print ("Testing %d shards by %d processes" % (len(tasks), jobs))
+        with multiprocessing.Pool(jobs, init_worker) as pool:
+            for done, (run_name, ma, shard_pairs, results) in enumerate(pool.imap_unordered(backtest_shard, tasks)):
+                analytics[run_name].merge(ma, shard_pairs, results)
+                print ("%d of %d shards done" % (done + 1, len(tasks)))
+
+    finally:
+        for arrays in shared:
+            arrays.unlink()
+
+    for run_name in runs.keys():
+        for ma in ma_types:
+            analytics[run_name].summarize(ma)
+
+    return analytics
+
+
+def walk_forward(runs, windows, jobs, fee, algorithm, av_periods, av_pairs, threshold_buy, threshold_sell,
+                 ma_types=('simple', 'exp'), engine='vector', grid_memory=256*1024*1024):
+    """
+    Walk-forward optimization of every run by jobs processes.
+    Averages and SAR are calculated once for all data, windows take their parts.
+    In every window the most profitable pair of in-sample part is tested on out-of-sample part.
+
+    runs - dictionary of run name: (MovingAverages, Data, SAR-like object)
+    windows - list of (in-sample start, out-of-sample start, out-of-sample end) timestamps
+    Returns dictionary of run name: list of (window, MA type, pair, in-sample profit, out-of-sample profit)
+    ordered by window and MA type. Windows with too few bars are skipped
+    """
+    periods = sorted(set(period for av_pair in av_pairs for period in av_pair))
+
+    shared = []
+    tasks = []
+    try:
+        specs = share_runs(runs, periods, ma_types, shared)
+        for run_name, (av_obj, data_obj, sar_obj) in runs.items():
+            for window in windows:
+                bars = tuple(int(index) for index in np.searchsorted(data_obj.time, window))
+                # Both parts need bars to trade on
+                if bars[1] - bars[0] < 2 or bars[2] - bars[1] < 2:
+                    continue
+                for ma in ma_types:
+                    tasks.append((run_name, specs[run_name], ma, periods, av_periods, av_pairs, window, bars,
+                                  fee, algorithm, threshold_buy, threshold_sell, engine, grid_memory))
+
+        print ("Testing %d windows by %d processes" % (len(tasks), jobs))
+        steps = dict((run_name, []) for run_name in runs.keys())
+        with multiprocessing.Pool(jobs, init_worker) as pool:
+            for done, (run_name, window, ma, best, in_profit, out_profit) in enumerate(pool.imap_unordered(walk_forward_window, tasks)):
+                steps[run_name].append((window, ma, best, in_profit, out_profit))
+                print ("%d of %d windows done" % (done + 1, len(tasks)))
+
+    finally:
+        for arrays in shared:
+            arrays.unlink()
+
+    for run_name in runs.keys():
+        steps[run_name].sort(key=lambda step: (step[0], ma_types.index(step[1])))
+    return steps
@@ -0,0 +1,137 @@
+import numpy as np
+
+import matplotlib as mp
+mp.use('agg')
+import matplotlib.pyplot as plt
+
+# Own package imports
+from common.basic import *
+
+"""
+Plots and stats files of backtest results
+
+Work on AveragesAnalytics objects either just tested or loaded
+from saved results, see AveragesAnalytics.save(). Run name is the
+resolution name of object, period and thresholds are taken from its info.
+"""
+
+
+# Heatmaps of pairs profit, one figure per run
+def plot_profit(analytics_list):
+    """ Colors of all figures are on the same scale """
+    # Find absolute profit min and max
+    abs_profit_min = min(min(an_obj.minimum_profit.values()) for an_obj in analytics_list)
+    abs_profit_max = max(max(an_obj.maximum_profit.values()) for an_obj in analytics_list)
+
+    for an_obj in analytics_list:
+        run_name = an_obj.resolution
+        timeperiod_str = an_obj.info.get('period', '')
+
+        # Separate figure with one column for every MA type
+        plot_columns = len(an_obj.ma_types)
+        plot_rows = 1
+
+        # Calculate dpi and font size based on grapsh size
+        dpi = (an_obj.results.shape[1] - 1) * 8
+        fontsize = 800 / dpi
+
+        fig = plt.figure(figsize=(10 * plot_columns, 6 * plot_rows))
+        plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+
+        for type_index, ma_type in enumerate(an_obj.ma_types):
+            print ("Building %s '%s' subplot" % (run_name, ma_type))
+            plot_data = np.ma.masked_invalid(an_obj.matrix('profit', ma_type))
+            plot_mask = np.ma.getmaskarray(plot_data)
+            min_profit = an_obj.minimum_profit[ma_type]
+            av_profit = an_obj.average_profit[ma_type]
+            max_profit = an_obj.maximum_profit[ma_type]
+
+            # Add thresholds values for algorithm #3
+            if an_obj.algorithm == 3:
+                thresholds_str = " Thresholds: buy %s, sell %s" % (an_obj.info.get('threshold_buy'), an_obj.info.get('threshold_sell'))
+            else:
+                thresholds_str = ""
+
+            plt.subplot2grid((plot_rows, plot_columns), (0, type_index))
+            plt.title("%s\n%s %s. Algorithm #%s%s\nMin: %.2f Av: %.2f Max: %.2f"
+                      % (timeperiod_str, run_name, ma_type, an_obj.algorithm, thresholds_str, min_profit, av_profit, max_profit))
+            for (x, y), value in np.ndenumerate(plot_data):
+                if plot_mask[x, y] == False:
+                    plt.text(x + 0.5, y + 0.5, '%.2f%%\n(%d, %d)' % (value, x, y), horizontalalignment='center', verticalalignment='center', fontsize=fontsize)
+
+            heatmap = plt.pcolormesh(plot_data.T, cmap=plt.cm.RdYlGn, vmin=abs_profit_min, vmax=abs_profit_max)
+
+            plt.colorbar(heatmap)
+            plt.gca().autoscale_view('tight')
+            # Turn off axis
+            plt.gca().axison = False
+
+        print ("Composing figure for %s" % run_name)
+        plt.tight_layout()
+        plt.savefig('plot-%s %s.png' % (run_name, timeperiod_str), dpi=dpi, bbox_inches='tight')
+        plt.close(fig)
+
+
+# Stats of every tested pair to text file
+def write_stats(an_obj):
+    run_name = an_obj.resolution
+    wr_stats = WriteStats('stats-%s %s.txt' % (run_name, an_obj.info.get('period', '')))
+
+    for ma in an_obj.ma_types:
+        print("Writing stats for", run_name, ma)
+        prog = Progress(len(an_obj.pairs))
+
+        for i, pair in enumerate(an_obj.pairs):
+            # Search tests different pairs of every MA type
+            if an_obj.result(ma, pair)['tested']:
+                wr_stats.append(an_obj, run_name, ma, pair)
+            prog.show(i)
+
+    del wr_stats
+
+
+# Walk-forward steps of run to text file, see parallel.walk_forward()
+def write_walk_forward(run_name, timeperiod_str, steps, ma_types):
+    """ Out-of-sample profits of all windows are compounded, windows without sells add nothing """
+    with open('walk-forward-%s %s.txt' % (run_name, timeperiod_str), 'w') as wf_file:
+        for ma in ma_types:
+            wf_file.write("==== %s %s ====\n" % (run_name, ma))
+            wf_file.write("In-sample from\tOut-of-sample from\tTo\tPair\tIn-sample profit\tOut-of-sample profit\n")
+            total = 1.
+            for (in_start, out_start, out_end), step_ma, pair, in_profit, out_profit in steps:
+                if step_ma != ma:
+                    continue
+                pair_str = "%d:%d" % pair if pair else "-"
+                wf_file.write("%s\t%s\t%s\t%s\t%.2f%%\t%.2f%%\n" % (dt_date(in_start), dt_date(out_start), dt_date(out_end),
+                                                                  pair_str, in_profit, out_profit))
+                if not np.isnan(out_profit):
+                    total *= 1 + out_profit / 100
+
+            print ("%s %s out-of-sample profit: %.2f%%" % (run_name, ma, (total - 1) * 100))
+            wf_file.write("Out-of-sample profit:\t%.2f%%\n\n" % ((total - 1) * 100))
+
+
+# Best pairs of every thresholds combination to text file, see AveragesAnalytics.sweep_thresholds()
+def write_thresholds(an_obj):
+    run_name = an_obj.resolution
+    with open('thresholds-%s %s.txt' % (run_name, an_obj.info.get('period', '')), 'w') as th_file:
+        for ma_index, ma in enumerate(an_obj.ma_types):
+            th_file.write("==== %s %s ====\n" % (run_name, ma))
+            th_file.write("Buy threshold\tSell threshold\tBest pair\tMax profit\tAv profit\n")
+            profit = np.ma.masked_invalid(an_obj.threshold_profit[ma_index])
+            for number, (t_buy, t_sell) in enumerate(an_obj.thresholds):
+                combination = profit[:, :, number]
+                if combination.count() == 0:
+                    th_file.write("%s\t%s\t-\tnan%%\tnan%%\n" % (t_buy, t_sell))
+                    continue
+                fast, slow = np.unravel_index(combination.argmax(), combination.shape)
+                th_file.write("%s\t%s\t%d:%d\t%.2f%%\t%.2f%%\n" % (t_buy, t_sell, fast, slow, combination.max(), combination.mean()))
+
+            if profit.count():
+                fast, slow, number = np.unravel_index(profit.argmax(), profit.shape)
+                t_buy, t_sell = an_obj.thresholds[number]
+                best = "%d:%d, thresholds buy %s sell %s, profit %.2f%%" % (fast, slow, t_buy, t_sell, profit.max())
+            else:
+                best = "none, nothing was sold"
+            print ("Best %s %s: %s" % (run_name, ma, best))
+            th_file.write("Best: %s\n\n" % best)
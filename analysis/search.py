@@ -0,0 +1,135 @@
+import numpy as np
+
+# Own package imports
+from .analysis import AveragesAnalytics, AveragesView, DataView, SARSeries
+
+"""
+Coarse-to-fine search of MA pairs (successive halving)
+
+The first round tests pairs of a sparse grid of periods on a short, most
+recent part of data. Every next round keeps 1/eta of the best pairs, adds
+their neighbours on a twice denser grid and tests them on eta times longer
+part of data. The last round tests pairs on the full grid and all data, only
+its results are kept. So profits of the most promising regions are found
+while a small part of all pairs is tested.
+"""
+
+
+# Number of rounds for count of periods
+def rounds_number(count):
+    """ Sparse grid of the first round has about sqrt(count) periods """
+    return max(int(np.log2(max(count, 2))) // 2, 1)
+
+
+# Pairs of every stride-th period, as indices of periods
+def grid_pairs(count, stride):
+    indices = list(range(0, count, stride))
+    # Keep the longest period in grid
+    if indices[-1] != count - 1:
+        indices.append(count - 1)
+    return set((fast, slow) for fast in indices for slow in indices if fast < slow)
+
+
+# Pairs around pairs within stride, as indices of periods
+def neighbours(pairs, count, stride):
+    found = set()
+    for fast, slow in pairs:
+        for fast_step in (-stride, 0, stride):
+            for slow_step in (-stride, 0, stride):
+                fast_index, slow_index = fast + fast_step, slow + slow_step
+                if 0 <= fast_index < slow_index < count:
+                    found.add((fast_index, slow_index))
+    return found
+
+
+def search(run_name, av_obj, data_obj, sar_obj, av_periods, fee, algorithm, threshold_buy, threshold_sell,
+           ma_types=('simple', 'exp'), eta=3, rounds=None, engine='vector', grid_memory=256*1024*1024, av_pairs=None):
+    """
+    Returns AveragesAnalytics with results of pairs tested by the last round.
+    Other pairs are not tested and are masked in results matrices.
+
+    eta - part of pairs kept by every round is 1/eta, data of every round is eta times longer
+    rounds - number of rounds after the first one. Default: see rounds_number()
+    av_pairs - pairs to choose from, all pairs of av_periods by default.
+               First round tests all of them if none is on its grid
+    """
+    periods = list(av_periods)
+    if rounds is None:
+        rounds = rounds_number(len(periods))
+    datalength = len(data_obj.price)
+
+    # Allowed pairs as indices of periods
+    if av_pairs is None:
+        allowed = grid_pairs(len(periods), 1)
+    else:
+        allowed = set((periods.index(fast), periods.index(slow)) for fast, slow in av_pairs)
+
+    final_pairs = {}
+    final_results = {}
+    # Bars of all pairs tested, to compare with testing of all pairs
+    work = 0
+
+    for ma in ma_types:
+        # Every round takes averages of different parts of data
+        matrix = av_obj.matrix(ma, periods)
+        for period in periods:
+            av_obj.release(ma, period)
+
+        stride = 2 ** rounds
+        candidates = grid_pairs(len(periods), stride) & allowed or allowed
+
+        for round_number in range(rounds + 1):
+            length = max(int(datalength * float(eta) ** (round_number - rounds)), 1)
+            start = datalength - length
+            ranked = sorted(candidates)
+            av_pairs = [(periods[fast], periods[slow]) for fast, slow in ranked]
+
+            print ("Search round %d of %d for %s '%s': %d pairs on last %d bars"
+                   % (round_number + 1, rounds + 1, run_name, ma, len(av_pairs), length))
+
+            sar_window = SARSeries()
+            sar_window.trend = sar_obj.trend[start:]
+            analytics = AveragesAnalytics(run_name, fee, algorithm)
+            analytics.backtest(AveragesView({ma: matrix[:, start:]}, periods),
+                               DataView(data_obj.time[start:], data_obj.price[start:]),
+                               av_periods, av_pairs, sar_window, threshold_buy, threshold_sell,
+                               (ma,), engine, grid_memory)
+            work += len(av_pairs) * length
+
+            if round_number == rounds:
+                break
+
+            # Pairs without sells are the worst
+            profit = np.array([analytics.result(ma, av_pair)['profit'] for av_pair in av_pairs])
+            profit[np.isnan(profit)] = -np.inf
+            keep = -(-len(ranked) // eta)
+            best = [ranked[number] for number in np.argsort(-profit, kind='stable')[:keep]]
+
+            stride = max(stride // 2, 1)
+            candidates = neighbours(best, len(periods), stride) & allowed
+
+        final_pairs[ma] = av_pairs
+        final_results[ma] = analytics.pair_results(ma, av_pairs)
+        del matrix
+
+    # Results of the last rounds of all MA types together
+    all_pairs = sorted(set(av_pair for av_pairs in final_pairs.values() for av_pair in av_pairs))
+    result = AveragesAnalytics(run_name, fee, algorithm)
+    result.init_results(ma_types, av_periods, all_pairs)
+    for ma in ma_types:
+        result.merge(ma, final_pairs[ma], final_results[ma])
+        result.summarize(ma)
+
+    full_work = len(allowed) * datalength * len(ma_types)
+    print ("%s search tested %.1f%% of pair bars of full backtest" % (run_name, work * 100. / full_work))
+
+    return result
+
+
+# Best tested pairs of MA type by profit
+def best_pairs(an_obj, ma, count=10):
+    """ Returns list of (profit, pair), the most profitable first """
+    profit = np.ma.masked_invalid(an_obj.matrix('profit', ma))
+    pairs = [(float(profit[pair]), pair) for pair in zip(*np.nonzero(~np.ma.getmaskarray(profit)))]
+    pairs.sort(key=lambda item: -item[0])
+    return [(value, (int(fast), int(slow))) for value, (fast, slow) in pairs[:count]]
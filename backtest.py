@@ -1,28 +1,36 @@
 #!/usr/bin/python3
 
+import os
 import sys
 import argparse
 import configparser
 
 import time as t
-import csv
 import datetime as dt
 
 import numpy as np
 import itertools
 
-import matplotlib as mp
-mp.use('agg')
-import matplotlib.pyplot as plt
-
 from analysis.analysis import *
+from analysis import parallel
+from analysis import search
+from analysis import checkpoint
+from analysis import report
 from common.basic import *
+from common import tickfile
+from common import tickstore
+from common import cache
 
 # Get configuration from ini
 config = configparser.ConfigParser()
 config.read('config.ini')
 resolutions = config['backtest']['resolutions']
 av_range = config['backtest']['average_periods']
+ema_type = config.get('backtest', 'ema', fallback='recursive')
+grid_memory = config.getint('backtest', 'grid_memory', fallback=256) * 1024 * 1024
+cache_dir = config.get('cache', 'directory', fallback='cache')
+cache_size = config.getint('cache', 'size', fallback=500) * 1024 * 1024
+cache_mmap = config.getint('cache', 'mmap', fallback=1) * 1024 * 1024
 
 # Dictionary for resolutions name:seconds
 resolutions_conf = resolutions_convert(resolutions)
@@ -36,7 +44,7 @@ av_pairs = list(itertools.combinations(av_periods, 2))
 
 # Parse arguments
 aparser = argparse.ArgumentParser()
-aparser.add_argument('-i', '--input', dest='datafile_path', required=True, help='CSV file to get data from')
+aparser.add_argument('-i', '--input', dest='datafile_path', required=True, help='CSV file or tick store to get data from')
 aparser.add_argument('-f', '--fee', dest='fee', help='Stock fee. Default: 0.002')
 aparser.add_argument('-p', '--period', dest='timedelta', nargs=2, metavar=('INTEGER', '{d|w|m|y}'), help='From what time ago to start analysis. Value with day/week/month/year suffix')
 aparser.add_argument('-s', '--start', dest='startdate', help='Date to start analysis from. Format: dd.mm.yy')
@@ -45,12 +53,61 @@ aparser.add_argument('-a', '--algorithm', dest='algorithm', help="""Algorithm to
 1: MA crossings (default).
 2: MA crossings with simple SAR (buy on crossing, sell on crossing + SAR trend down).
 3: MA crossings with thresholds (see analysis/analysis.py decision()).""")
-aparser.add_argument('-tb', '--threshold-buy', dest='threshold_buy', help='Relative difference between MAs to generate buy signal. Default 0.25.')
-aparser.add_argument('-ts', '--threshold-sell', dest='threshold_sell', help='Relative difference between MAs to generate sell signal. Default 0.25.')
+aparser.add_argument('-tb', '--threshold-buy', dest='threshold_buy', help='Relative difference between MAs to generate buy signal. Default 0.25. With --sweep: comma separated values and start:stop:step ranges, e.g. 0.1:0.5:0.1')
+aparser.add_argument('-ts', '--threshold-sell', dest='threshold_sell', help='Relative difference between MAs to generate sell signal. Default 0.25. With --sweep: same as --threshold-buy')
+aparser.add_argument('--sweep', dest='sweep', action='store_true', help='Test all combinations of buy and sell thresholds of algorithm #3 in one pass instead of backtest. Profits go to thresholds-<run> <period>.npz, best pairs of every combination to thresholds-<run> <period>.txt')
+aparser.add_argument('--af-inc', dest='af_inc', help='SAR acceleration factor increment. Comma separated values are all tested with algorithm #2. Default: 0.02')
+aparser.add_argument('--af-max', dest='af_max', help='SAR acceleration factor maximum. Comma separated values are all tested with algorithm #2. Default: 0.2')
+aparser.add_argument('-m', '--ma', dest='ma_types', choices=('simple', 'exp'), action='append', help='MA type to test, may be repeated. Default: both')
+aparser.add_argument('--pairs', dest='pairs', help='Comma separated fast:slow periods pairs to test, e.g. 13:27,5:10. Default: all pairs of average_periods')
+aparser.add_argument('--engine', dest='engine', choices=('vector', 'grid', 'loop'), help='Backtest engine: vector finds trades from signal arrays, grid does it for blocks of pairs at once, loop steps through every bar. Results are the same. Default: vector')
+aparser.add_argument('--search', dest='search', action='store_true', help='Coarse-to-fine search instead of testing all pairs: sparse grid of periods on a short part of data first, then only the best regions on denser grids and longer data. Only pairs of the last round are in results')
+aparser.add_argument('--search-eta', dest='search_eta', type=int, help='Every search round keeps 1/ETA of the best pairs and tests them on ETA times longer data. Default: 3')
+aparser.add_argument('--walk-forward', dest='walk_forward', nargs=2, metavar=('IN', 'OUT'), help='Walk-forward optimization instead of backtest: the best pair of every IN long window is tested on the next OUT long window, windows step by OUT. Values with day/week/month/year suffix, e.g. 2m 2w. Results go to walk-forward-<run> <period>.txt')
+aparser.add_argument('-j', '--jobs', dest='jobs', type=int, help='Number of processes to backtest with. Default: 1')
+aparser.add_argument('--ledger', dest='save_ledger', action='store_true', help='Save trades of every pair to ledger-<run> <period>.npz')
+aparser.add_argument('--save-results', dest='save_results', action='store_true', help='Save results to results-<run> <period>.npz to plot and write stats later by show_results.py')
+aparser.add_argument('--checkpoint', dest='checkpoint_dir', help='Save checkpoint of every run to <directory>/<run>.npz to continue it on new data by resume_backtest.py')
 aparser.add_argument('--no-plot', dest='do_plot', action='store_false', help='Do not draw plots, just show text stats')
-aparser.set_defaults(do_plot=True, fee=0.002, algorithm=1, threshold_buy=0.25, threshold_sell=0.25)
+aparser.add_argument('--no-cache', dest='use_cache', action='store_false', help='Do not use cached intervals and indicators data, build it from ticks')
+aparser.set_defaults(do_plot=True, save_ledger=False, save_results=False, use_cache=True, fee=0.002, algorithm=1, threshold_buy=0.25, threshold_sell=0.25, af_inc='0.02', af_max='0.2', engine='vector', jobs=1, search_eta=3)
 args = aparser.parse_args()
 
+# MA types and pairs to test. Averages are calculated only for them
+ma_types = tuple(args.ma_types or ('simple', 'exp'))
+if args.pairs:
+    av_pairs = [tuple(int(period) for period in pair.split(':')) for pair in args.pairs.split(',')]
+    if any(period not in av_periods for pair in av_pairs for period in pair):
+        print ("Error: pairs periods must be within average_periods %s" % av_range)
+        sys.exit(1)
+
+# Modes which replace full backtest, they can not be combined
+modes = [option for option, given in (('--search', args.search), ('--walk-forward', args.walk_forward), ('--sweep', args.sweep)) if given]
+if len(modes) > 1:
+    print ("Error: %s can not be used together" % ', '.join(modes))
+    sys.exit(1)
+
+# Options given with values other than defaults
+options = {'-j': args.jobs != 1, '--engine': args.engine != 'vector', '--search-eta': args.search_eta != 3,
+           '--ledger': args.save_ledger, '--save-results': args.save_results, '--checkpoint': bool(args.checkpoint_dir)}
+# Options every mode has no use for, --pairs is taken by all of them
+unsupported = {None: ('--search-eta',),
+               '--search': ('-j', '--checkpoint'),
+               '--walk-forward': ('--search-eta', '--ledger', '--save-results', '--checkpoint'),
+               '--sweep': ('-j', '--engine', '--search-eta', '--ledger', '--save-results', '--checkpoint')}
+mode = modes[0] if modes else None
+ignored = [option for option in unsupported[mode] if options[option]]
+if ignored:
+    print ("Error: %s can not be used %s" % (', '.join(ignored), 'with ' + mode if mode else 'without --search'))
+    sys.exit(1)
+
+if args.sweep:
+    if int(args.algorithm) != 3:
+        print ("Error: thresholds sweep works with algorithm #3 only")
+        sys.exit(1)
+    thresholds_buy = values_convert(str(args.threshold_buy))
+    thresholds_sell = values_convert(str(args.threshold_sell))
+
 now = int(dt.datetime.now().strftime('%s'))
 
 # Decode symbol from period argument
@@ -72,88 +129,151 @@ else:
     endtime = now
 
 
-# Open file and determine human-readable start-end interval
-datafile = open(args.datafile_path, newline='')
+# Determine human-readable start-end interval
 timeperiod_str = "%s - %s" % (dt.datetime.fromtimestamp(starttime), dt.datetime.fromtimestamp(endtime))
 
-# Read all data from csv file to data class
-rowcount = 0
-full_data = Data()
-
 # Import data from n earlier periods too to calculate correct averages for the start of interval
-lookback_time = starttime - (max(resolutions_conf.values()) * max(av_periods))
+import_lookback = starttime - (max(resolutions_conf.values()) * max(av_periods))
 
-print ("Importing data for %s" % timeperiod_str)
-print ("Lookback time: %s" % dt.datetime.fromtimestamp(lookback_time))
-
-for row in csv.reader(datafile):
-    if lookback_time < int(row[0]):
-        full_data.append(row[0], row[1])
-        rowcount += 1
-        if rowcount % 100000 == 0:
-            print("Row: %s" % rowcount)
-        if int(row[0]) >= endtime:
-            break
-
-datafile.close()
+# Determine lookback time for every resolution
+lookbacks = {}
+for res_name, res_value in resolutions_conf.items():
+    lookbacks[res_name] = starttime - (res_value * max(av_periods))
+    print ("Lookback time for %s is %s" % (res_name, dt.datetime.fromtimestamp(lookbacks[res_name])))
 
-# Get full_data arrays' size and check it against rowcount of the source file
-fulldata_len = len(full_data.time)
-assert rowcount == fulldata_len == len(full_data.price)
+if tickstore.is_store(args.datafile_path):
+    source = tickstore.TickStore(args.datafile_path)
+    data_max_time = source.max_time
+else:
+    source = None
+    # Index gives the last tick time for cache keys and lets reading skip to lookback time
+    if tickfile.load_csv_index(args.datafile_path) is None:
+        print ("Indexing %s" % args.datafile_path)
+        try:
+            tickfile.update_csv_index(args.datafile_path)
+        except OSError as error:
+            print ("Index not saved: %s" % error)
+    data_max_time = tickfile.max_time(args.datafile_path)
+
+# Dictionary of data objects
+discrete_data = {}
 
-print ('Data read')
+# Take intervals data from cache if it was built before from the same data
+if args.use_cache:
+    bars_cache = cache.DiskCache(cache_dir, cache_size, cache_mmap)
+    source_id = cache.source_identity(args.datafile_path)
+    # End time makes no difference when all data is before it
+    if data_max_time is not None and endtime > data_max_time:
+        end_key = None
+    else:
+        end_key = endtime
+
+    cache_keys = {}
+    for res_name, res_value in resolutions_conf.items():
+        # Ticks exactly at lookback time are not imported for the coarsest resolution
+        tick_at_lookback = lookbacks[res_name] > import_lookback
+        cache_keys[res_name] = cache.key('bars', source_id, res_value, lookbacks[res_name], tick_at_lookback, end_key)
+        cached = bars_cache.load(cache_keys[res_name])
+        # Checkpoints need the interval in progress and number of rows read, which entries of older versions lack
+        if cached is not None and args.checkpoint_dir and not ('interval_end' in cached and 'next_row' in cached):
+            cached = None
+        if cached is not None:
+            print ("Using cached %s data" % res_name)
+            discrete_data[res_name] = Data(res_value)
+            discrete_data[res_name].load_arrays(cached)
+            if 'interval_end' in cached:
+                discrete_data[res_name].load_interval_state(cached)
+            actual_endtime = int(cached['last_time'])
+            if 'next_row' in cached:
+                next_row = int(cached['next_row'])
+
+missing = [res_name for res_name in resolutions_conf.keys() if res_name not in discrete_data]
+
+if missing:
+    # Ticks strictly after import lookback are taken, so step one second back
+    # to get ticks at lookback time of the coarsest missing resolution
+    lookback_time = max(import_lookback, min(lookbacks[res_name] for res_name in missing) - 1)
+
+    print ("Importing data for %s" % timeperiod_str)
+    print ("Lookback time: %s" % dt.datetime.fromtimestamp(lookback_time))
+
+    if source is not None:
+        chunks = source.read_rows(lookback_time, endtime)
+    else:
+        chunks = tickfile.read_rows(args.datafile_path, lookback_time, endtime)
+
+    # Stream ticks straight into data objects of every missing resolution.
+    # Only one chunk of ticks is kept in memory at a time.
+    # Coarser resolutions are derived from finer ones where possible
+    resampler = Resampler({res_name: resolutions_conf[res_name] for res_name in missing},
+                          {res_name: lookbacks[res_name] for res_name in missing})
+    rowcount = 0
+    next_row = 0
+    for time, price, amount, next_row in chunks:
+        resampler.extend(time, price)
+        rowcount += len(time)
+        actual_endtime = int(time[-1])
+        print("Row: %s" % rowcount)
+
+    print ('Data read')
+
+    for res_name in missing:
+        discrete_data[res_name] = resampler.data[res_name]
+        if args.use_cache:
+            bars_cache.save(cache_keys[res_name], dict(discrete_data[res_name].arrays(), last_time=actual_endtime, next_row=next_row,
+                                                       **(discrete_data[res_name].interval_state() or {})))
+
+    del resampler
+
+# Averages and SAR are cached as well, keyed by intervals data they are calculated from
+if args.use_cache:
+    indicators_cache = bars_cache
+else:
+    indicators_cache = None
 
-actual_endtime = full_data.time[-1]
 if actual_endtime < endtime:
     print ("Last data point is at %s" % dt.datetime.fromtimestamp(actual_endtime))
     timeperiod_str = "%s - %s" % (dt.datetime.fromtimestamp(starttime), dt.datetime.fromtimestamp(actual_endtime))
 
 print ("\n")
 
-# Init dictionary for data objects
-discrete_data = {}
-
-for res_name, res_value in resolutions_conf.items():
-    print ("Filling %s data object" % res_name)
-
-    # Create data objects for every configured resolution and put them in a dict
-    discrete_data[res_name] = Data(res_value)
-
-    prog = Progress(fulldata_len)
-
-    # Determine lookback time for current resolution
-    lookback_time = starttime - (res_value * max(av_periods))
-    print ("Lookback time for %s is %s" % (res_name, dt.datetime.fromtimestamp(lookback_time)))
-
-    # Fill in discrete data objects
-    for index in range(fulldata_len):
-        if full_data.read(index)['time'] >= lookback_time:
-            discrete_data[res_name].append(full_data.read(index)['time'], full_data.read(index)['price'])
-        prog.show(index)
-
-# No need to keep all data in memory now
-del full_data
-
 
 av = {}
 for res_name in resolutions_conf.keys():
     print ("Computing %s averages object" % res_name)
     # Create averages objects for every configured resolution and put them in a dict
-    av[res_name] = MovingAverages(discrete_data[res_name], av_periods)
+    av[res_name] = MovingAverages(discrete_data[res_name], av_periods, ema_type=ema_type, cache_obj=indicators_cache)
 
-    # Check lenghts
-    assert len(av[res_name].ma['simple'][av_min_period+1]) == len(av[res_name].ma['simple'][av_max_period-1]) == \
-        len(av[res_name].ma['exp'][av_min_period+1]) == len(av[res_name].ma['exp'][av_max_period-1]) == \
+    # Check lenghts. Averages are calculated later, when used
+    assert len(av[res_name].price) - av[res_name].cut == \
         len(discrete_data[res_name].time) == len(discrete_data[res_name].price) == \
         len(discrete_data[res_name].high) == len(discrete_data[res_name].low)
 
+# SAR parameters pairs. Only algorithm #2 uses SAR, so others take just the first pair
+af_incs = [float(value) for value in args.af_inc.split(',')]
+af_maxs = [float(value) for value in args.af_max.split(',')]
+if int(args.algorithm) == 2:
+    sar_params = list(itertools.product(af_incs, af_maxs))
+else:
+    sar_params = [(af_incs[0], af_maxs[0])]
+
 SARs = {}
 for res_name in resolutions_conf.keys():
     print ("Computing %s SAR object" % res_name)
-    # Dictionary for SAR objects of different resolutions
-    SARs[res_name] = SAR(discrete_data[res_name])
+    # Dictionary for SAR objects of different resolutions, all parameters pairs at once
+    SARs[res_name] = SARGrid(discrete_data[res_name], sar_params, indicators_cache)
+
+    assert SARs[res_name].trend.shape == SARs[res_name].sar.shape == (len(sar_params), len(discrete_data[res_name].time))
 
-    assert len(SARs[res_name].trend) == len(SARs[res_name].sar) == len(discrete_data[res_name].time)
+# Backtest runs, name: (resolution name, index of SAR parameters pair)
+runs = {}
+for res_name in resolutions_conf.keys():
+    for sar_index, (af_inc, af_max) in enumerate(sar_params):
+        if len(sar_params) > 1:
+            run_name = "%s SAR %s-%s" % (res_name, af_inc, af_max)
+        else:
+            run_name = res_name
+        runs[run_name] = (res_name, sar_index)
 
 """
 p_res="1h"
@@ -166,82 +286,118 @@ for index, time in enumerate(discrete_data[p_res].time):
             av[p_res].ma['exp'][3][index]))
 """
 
-analytics = {}
-for res_name in resolutions_conf.keys():
-    analytics[res_name] = AveragesAnalytics(res_name, args.fee, args.algorithm)
-    analytics[res_name].backtest(av[res_name], discrete_data[res_name], av_periods, av_pairs, SARs[res_name], args.threshold_buy, args.threshold_sell)
+if args.walk_forward:
+    window_lengths = []
+    for value in args.walk_forward:
+        if value[:-1].isdigit() and value[-1] in period_decode:
+            window_lengths.append(int(value[:-1]) * period_decode[value[-1]])
+        else:
+            print ("Error: walk-forward window length must be an integer with d/w/m/y suffix, got %s" % value)
+            sys.exit(1)
+    in_length, out_length = window_lengths
+
+    # Rolling windows of (in-sample start, out-of-sample start, out-of-sample end) within data
+    windows = []
+    if starttime:
+        window_start = starttime
+    else:
+        window_start = min(int(data_obj.time[0]) for data_obj in discrete_data.values())
+    while window_start + in_length + out_length <= actual_endtime:
+        windows.append((window_start, window_start + in_length, window_start + in_length + out_length))
+        window_start += out_length
+
+    if not windows:
+        print ("Error: no walk-forward window fits %s" % timeperiod_str)
+        sys.exit(1)
+
+    wf_runs = dict((run_name, (av[res_name], discrete_data[res_name], SARs[res_name].series(sar_index)))
+                   for run_name, (res_name, sar_index) in runs.items())
+    steps = parallel.walk_forward(wf_runs, windows, args.jobs, args.fee, args.algorithm, av_periods, av_pairs,
+                                  args.threshold_buy, args.threshold_sell, ma_types, args.engine, grid_memory)
+    del wf_runs
+
+    for run_name in runs.keys():
+        report.write_walk_forward(run_name, timeperiod_str, steps[run_name], ma_types)
+
+    # No heatmaps for walk-forward
+    sys.exit(0)
+
+if args.sweep:
+    for run_name, (res_name, sar_index) in runs.items():
+        an_obj = AveragesAnalytics(run_name, args.fee, args.algorithm)
+        an_obj.sweep_thresholds(av[res_name], discrete_data[res_name], av_periods, av_pairs,
+                                thresholds_buy, thresholds_sell, ma_types, grid_memory)
+        an_obj.info = {'period': timeperiod_str}
+        an_obj.save_thresholds('thresholds-%s %s.npz' % (run_name, timeperiod_str))
+        report.write_thresholds(an_obj)
+        print ("")
+
+    # Profit cubes are not drawn
+    sys.exit(0)
+
+if args.search:
+    # Pairs to test are chosen by search rounds
+    analytics = {}
+    for run_name, (res_name, sar_index) in runs.items():
+        analytics[run_name] = search.search(run_name, av[res_name], discrete_data[res_name], SARs[res_name].series(sar_index),
+                                            av_periods, args.fee, args.algorithm, args.threshold_buy, args.threshold_sell,
+                                            ma_types, args.search_eta, engine=args.engine, grid_memory=grid_memory,
+                                            av_pairs=av_pairs)
+        for ma in ma_types:
+            print ("Best %s '%s' pairs:" % (run_name, ma))
+            for profit, (fast_period, slow_period) in search.best_pairs(analytics[run_name], ma):
+                print ("  %d:%d %.2f%%" % (fast_period, slow_period, profit))
+        print ("")
+elif args.jobs > 1:
+    # Pairs of all runs are shared out between processes
+    parallel_runs = dict((run_name, (av[res_name], discrete_data[res_name], SARs[res_name].series(sar_index)))
+                         for run_name, (res_name, sar_index) in runs.items())
+    analytics = parallel.backtest(parallel_runs, args.jobs, args.fee, args.algorithm, av_periods, av_pairs,
+                                  args.threshold_buy, args.threshold_sell, ma_types, args.engine, grid_memory)
+    del parallel_runs
     print ("")
+else:
+    analytics = {}
+    for run_name, (res_name, sar_index) in runs.items():
+        analytics[run_name] = AveragesAnalytics(run_name, args.fee, args.algorithm)
+        analytics[run_name].backtest(av[res_name], discrete_data[res_name], av_periods, av_pairs, SARs[res_name].series(sar_index), args.threshold_buy, args.threshold_sell, ma_types, args.engine, grid_memory)
+        print ("")
+
+if args.save_ledger:
+    for run_name in runs.keys():
+        print ("Saving %s trades ledger" % run_name)
+        analytics[run_name].save_ledger('ledger-%s %s.npz' % (run_name, timeperiod_str))
+
+# Description of runs to show in plots and to save with results
+for run_name in runs.keys():
+    analytics[run_name].info = {'period': timeperiod_str, 'threshold_buy': args.threshold_buy, 'threshold_sell': args.threshold_sell}
+
+if args.save_results:
+    for run_name in runs.keys():
+        print ("Saving %s results" % run_name)
+        analytics[run_name].save('results-%s %s.npz' % (run_name, timeperiod_str))
+
+if args.checkpoint_dir:
+    if not os.path.isdir(args.checkpoint_dir):
+        os.makedirs(args.checkpoint_dir)
+    for run_name, (res_name, sar_index) in runs.items():
+        print ("Saving %s checkpoint" % run_name)
+        af_inc, af_max = sar_params[sar_index]
+        settings = {'threshold_buy': args.threshold_buy, 'threshold_sell': args.threshold_sell, 'starttime': starttime,
+                    'lookback': lookbacks[res_name]}
+        run_checkpoint = checkpoint.Checkpoint.create(analytics[run_name], av[res_name], discrete_data[res_name], SARs[res_name].series(sar_index),
+                                                      af_inc, af_max, settings, actual_endtime, next_row)
+        run_checkpoint.save(os.path.join(args.checkpoint_dir, '%s.npz' % run_name))
+        del run_checkpoint
+
+# Averages are not needed anymore
+del av
 
 if args.do_plot:
-
-    # Find absolute profit min and max
-    abs_profit_min = min(min(val) for val in [profit_dict.values() for profit_dict in [an_obj.minimum_profit for an_obj in analytics.values()]])
-    abs_profit_max = max(max(val) for val in [profit_dict.values() for profit_dict in [an_obj.maximum_profit for an_obj in analytics.values()]])
-
-    # Separate figure with one column for every resolution
-    plot_columns = 2
-    # One row for SMA, second for EMA
-    plot_rows = 1
-
-    # Calculate dpi and font size based on grapsh size
-    dpi = max(av_periods) * 8
-    fontsize = 800 / dpi
-
-    for res_index, (res_name, res_value) in enumerate(resolutions_conf.items()):
-
-        fig = plt.figure(figsize=(10 * plot_columns, 6 * plot_rows))
-        plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-        for type_index, ma_type in enumerate(('simple', 'exp')):
-            print ("Building %s '%s' subplot" % (res_name, ma_type))
-            plot_data = analytics[res_name].profit[ma_type]
-            plot_mask = np.ma.getmaskarray(plot_data)
-            min_profit = analytics[res_name].minimum_profit[ma_type]
-            av_profit = analytics[res_name].average_profit[ma_type]
-            max_profit = analytics[res_name].maximum_profit[ma_type]
-
-            # Add thresholds values for algorithm #3
-            if int(args.algorithm) == 3:
-                thresholds_str = " Thresholds: buy %s, sell %s" % (args.threshold_buy, args.threshold_sell)
-            else:
-                thresholds_str = ""
-
-            plt.subplot2grid((plot_rows, plot_columns), (0, type_index))
-            plt.title("%s\n%s %s. Algorithm #%s%s\nMin: %.2f Av: %.2f Max: %.2f"
-                      % (timeperiod_str, res_name, ma_type, args.algorithm, thresholds_str, min_profit, av_profit, max_profit))
-            for (x, y), value in np.ndenumerate(plot_data):
-                if plot_mask[x, y] == False:
-                    plt.text(x + 0.5, y + 0.5, '%.2f%%\n(%d, %d)' % (value, x, y), horizontalalignment='center', verticalalignment='center', fontsize=fontsize)
-
-            heatmap = plt.pcolormesh(plot_data.T, cmap=plt.cm.RdYlGn, vmin=abs_profit_min, vmax=abs_profit_max)
-
-            plt.colorbar(heatmap)
-            plt.gca().autoscale_view('tight')
-            # Turn off axis
-            plt.gca().axison = False
-
-        # Free up memory of plotted object
-        del av[res_name]
-
-        print ("Composing figure for %s resolution" % res_name)
-        plt.tight_layout()
-        plt.savefig('plot-%s %s.png' % (res_name, timeperiod_str), dpi=dpi, bbox_inches='tight')
-        del fig
-
+    report.plot_profit(list(analytics.values()))
 else:
     print ("Plotting skipped")
 
 # Print stats to file
-for res_name in resolutions_conf.keys():
-    wr_stats = WriteStats('stats-%s %s.txt' % (res_name, timeperiod_str))
-
-    for ma in ('simple', 'exp'):
-        print("Writing stats for", res_name, ma)
-        prog = Progress(len(av_pairs))
-
-        for i, pair in enumerate(av_pairs):
-            wr_stats.append(analytics[res_name], res_name, ma, pair)
-            prog.show(i)
-
-    del wr_stats
-
+for run_name in runs.keys():
+    report.write_stats(analytics[run_name])
@@ -12,7 +12,9 @@ from decimal import Decimal
 
 from common.basic import *
 from common import datadownload as dd
+from common import tickstore
 from analysis.analysis import *
+from analysis import incremental
 import bot.data
 
 # Get configuration from ini
@@ -20,6 +22,7 @@ config = configparser.ConfigParser()
 config.read('config.ini')
 fast = int(config['bot']['fast'])
 slow = int(config['bot']['slow'])
+ema_type = config.get('bot', 'ema', fallback='recursive')
 stop_loss = config['bot']['stop_loss']
 res_name = config['bot']['resolution']
 res_value = resolutions_convert(res_name)[res_name]
@@ -30,6 +33,8 @@ trading_sum = Decimal(config['bot']['trading_sum'])
 aparser = argparse.ArgumentParser()
 aparser.add_argument('-r', '--real', dest='real_trading', action="store_true",
                      help='Activate real trading')
+aparser.add_argument('-i', '--input', dest='datafile_path',
+                     help='Tick store to take initial data from')
 aparser.set_defaults(real_trading=False)
 args = aparser.parse_args()
 
@@ -204,19 +209,47 @@ class Trading(object):
 start_time = now() - res_value * slow
 #print("Lookback time:", dt.datetime.fromtimestamp(start_time))
 
-# Fill in initial data from bitcoincharts.com
 working_dataset = Data(res_value)
-new_data, last_timestamp = dd.btccharts(start_time)
+
+# Fill in initial data available locally
+download_from = start_time
+boundary = ()
+last_tick = None
+if args.datafile_path:
+    store = tickstore.TickStore(args.datafile_path)
+    for time, price, amount in store.read_chunks(start_time):
+        working_dataset.extend(time, price)
+        last_tick = (time[-1], price[-1])
+    # Trades of the last stored second are not downloaded again
+    if store.rows > 0 and store.last_time >= start_time:
+        download_from, boundary = dd.StoreTarget(args.datafile_path).boundary()
+
+# Fill in the rest from bitcoincharts.com
+new_data, last_timestamp = dd.btccharts(download_from, boundary)
 for value in new_data:
     time = value.split(',')[0]
     price = value.split(',')[1]
     working_dataset.append(time, price)
+    last_tick = (time, price)
+
+if last_tick is None:
+    print("Error: no data since %s" % dt.datetime.fromtimestamp(start_time))
+    exit(1)
 
-# Explicitly update dataset with last values
-working_dataset.update(time, price)
+# Explicitly update dataset with last downloaded values
+if new_data:
+    working_dataset.update(*last_tick)
 
 # Record last price
-shared_data.price = working_dataset.price[-1]
+shared_data.price = float(working_dataset.price[-1])
+
+# Indicators are updated along with working dataset
+fast_ma = incremental.average('exp', fast, ema_type)
+slow_ma = incremental.average('exp', slow, ema_type)
+sar = incremental.SAR()
+indicators = (fast_ma, slow_ma, sar)
+for indicator in indicators:
+    indicator.extend(working_dataset)
 
 if shared_data.real_trading:
     # Activate trading object
@@ -252,24 +285,23 @@ while True:
     else:
         for t in last_trades:
             time = dt_timestamp(t.date)
-            working_dataset.update(time, t.price)
-
-        # Calculate averages based on working dataset
-        mas = MovingAverages(working_dataset, (fast, slow), realtime=True)
-        # Calculate SAR for working dataset
-        sar = SAR(working_dataset)
-
-        fast_value = mas.ma['exp'][fast][-1]
-        slow_value = mas.ma['exp'][slow][-1]
-        trend = sar.trend[-1]
-        shared_data.price = working_dataset.price[-1]
-        time = working_dataset.time[-1]
+            new_element = working_dataset.update(time, t.price)
+            # Move averages and SAR only by changed element
+            if new_element is not None:
+                for indicator in indicators:
+                    indicator.update(working_dataset, new_element)
+
+        fast_value = fast_ma.value
+        slow_value = slow_ma.value
+        trend = sar.trend
+        shared_data.price = float(working_dataset.price[-1])
+        time = int(working_dataset.time[-1])
 
         '''
         print (dt_date(time), shared_data.price,
             working_dataset.high[-1], working_dataset.low[-1],
             "\tFast: %.2f slow: %.2f SAR: %.2f Trend: %s"
-            % (fast_value, slow_value, sar.sar[-1], trend))
+            % (fast_value, slow_value, sar.sar, trend))
         '''
 
         # If buy signal
@@ -1,40 +1,48 @@
 #!/usr/bin/python3
 
 import argparse
+import os
 
 # Own package imports
 from common.basic import *
+from common import tickfile
+from common import tickorder
 
 """
 
 Script to find trades that are out of order in CSV file
 Commonly seen in bitcoincharts.com files (at least btceUSD.csv)
-Then file can be fixed by running
-sort -t ',' -k 1 -o <output_file> <input_file>
+Then file can be fixed by running it with --fix
 
 """
 
 aparser = argparse.ArgumentParser()
 aparser.add_argument('-f', dest='datafile_path', required=True, help='CSV file to work on')
+aparser.add_argument('--fix', dest='fix', action='store_true', help='Sort out of order trades')
+aparser.add_argument('-o', dest='output_path', help='File to write fixed data to. Default: fix file in place')
+aparser.add_argument('-j', '--jobs', dest='jobs', type=int, help='Number of processes to scan file with. Default: number of cores')
+aparser.add_argument('-m', '--memory', dest='memory', type=int, default=256, help='Memory limit for fixing, MB. Default: 256')
 args = aparser.parse_args()
 
-with open(args.datafile_path, 'r') as f:
-    # Buffer list
-    buf = []
-    # Put first line
-    buf.append(f.readline())
-    for i, line in enumerate(f):
-       # Put current line into buffer
-       buf.append(line)
+regions = tickorder.find_regions(args.datafile_path, args.jobs)
 
-       prev_timestamp = float(buf[0].split(",")[0])
-       cur_timestamp = float(buf[1].split(",")[0])
+for first_row, last_row, start, end, low, high in regions:
+    print("Lines %d-%d (bytes %d-%d) out of order: %s - %s"
+          % (first_row + 1, last_row + 1, start, end, dt_date(low), dt_date(high)))
 
-       # Timestamps can be only ascending
-       if prev_timestamp > cur_timestamp:
-           print("%s detected around %s" % (dt_date(prev_timestamp), dt_date(cur_timestamp)))
+print("%d out of order regions found" % len(regions))
 
-       del buf[0]
-       if i % 100000 == 0:
-           print("Line: %s" % i)
+if args.fix and regions:
+    output_path = args.output_path or args.datafile_path + '.sorted'
+    tickorder.fix_order(args.datafile_path, output_path, regions, args.memory * 1024 * 1024)
 
+    if not args.output_path:
+        os.replace(output_path, args.datafile_path)
+
+    # Index of fixed file has to be rebuilt
+    fixed_path = args.output_path or args.datafile_path
+    if os.path.exists(tickfile.csv_index_path(args.datafile_path)):
+        print("Updating index")
+        tickfile.save_csv_index(fixed_path, tickfile.index_csv(fixed_path))
+
+    print("Fixed data written to %s" % fixed_path)
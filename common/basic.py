@@ -24,6 +24,7 @@ class WriteStats(object):
         self.f = open(statsfile, 'a')
 
     def append(self, analytics_obj, res_name, ma, pair):
+        result = analytics_obj.result(ma, pair)
         data = """\
 ==== %s %s %s ====
 Pair profitability:	%.2f%%
@@ -40,17 +41,17 @@ Max consecutive loss:	%.2f%%
 
 """ % (
             res_name, ma, pair,
-            analytics_obj.profit[ma][pair[0]][pair[1]],
-            analytics_obj.biggest_win[ma][pair],
-            analytics_obj.biggest_loss[ma][pair],
-            analytics_obj.won_trades_sum[ma][pair],
-            analytics_obj.lost_trades_sum[ma][pair],
-            analytics_obj.won_trades_num[ma][pair],
-            analytics_obj.lost_trades_num[ma][pair],
-            analytics_obj.max_consecutive_wins[ma][pair],
-            analytics_obj.max_consecutive_losts[ma][pair],
-            analytics_obj.max_consecutive_profit[ma][pair],
-            analytics_obj.max_consecutive_loss[ma][pair]
+            result['profit'],
+            result['biggest_win'],
+            result['biggest_loss'],
+            result['won_trades_sum'],
+            result['lost_trades_sum'],
+            result['won_trades_num'],
+            result['lost_trades_num'],
+            result['max_consecutive_wins'],
+            result['max_consecutive_losts'],
+            result['max_consecutive_profit'],
+            result['max_consecutive_loss']
             )
 
         self.f.write(data)
@@ -88,3 +89,18 @@ def resolutions_convert(res_string):
         resolutions_conf[res] = amount * multiplier
 
     return resolutions_conf
+
+# Function to convert comma separated values and start:stop:step ranges to list of floats
+# Stop value is included, e.g. 0.1:0.3:0.1,0.5 gives [0.1, 0.2, 0.3, 0.5]
+def values_convert(values_string):
+    values = []
+    for item in values_string.split(','):
+        if ':' in item:
+            start, stop, step = map(float, item.split(':'))
+            count = int(round((stop - start) / step)) + 1
+            # Round to get 0.3 instead of 0.30000000000000004
+            values.extend(round(start + step * number, 10) for number in range(count))
+        else:
+            values.append(float(item))
+
+    return values
@@ -0,0 +1,148 @@
+import os
+import shutil
+import hashlib
+
+import numpy as np
+
+"""
+On-disk cache of numpy arrays
+
+Every entry is a directory named by key with one .npy file per array.
+Entry directory modification time is its last use time, so the least
+recently used entries are removed first when cache grows over its size.
+Cache directory is scanned only when the size it had after the last scan
+plus entries saved since then goes over the limit, and then it is cleaned
+to EVICT_TO part of the limit, so saving many entries does not rescan it every time.
+"""
+
+# Part of the size limit cache is cleaned to when it goes over the limit
+EVICT_TO = 0.8
+
+
+# Make cache key of any printable values
+def key(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+# Fingerprint of array contents: changes when any value, type or shape changes
+def fingerprint(*arrays):
+    digest = hashlib.sha1()
+    for values in arrays:
+        values = np.ascontiguousarray(values)
+        digest.update(repr((values.dtype.str, values.shape)).encode())
+        digest.update(values.data)
+    return digest.hexdigest()
+
+
+# Identity of a file or directory: changes when data is modified or appended
+def source_identity(path):
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        files = sorted(os.listdir(path))
+    else:
+        path, files = os.path.split(path)
+        files = [files]
+
+    identity = [path]
+    for name in files:
+        stat = os.stat(os.path.join(path, name))
+        identity.append((name, stat.st_size, stat.st_mtime_ns))
+    return tuple(identity)
+
+
+class DiskCache(object):
+    """
+    path - cache directory, created when needed
+    max_size - size limit in bytes
+    mmap_size - arrays bigger than that are memory mapped on load instead of read
+    """
+    def __init__(self, path, max_size, mmap_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.mmap_size = mmap_size
+        # Cache size known without scanning, None until the first scan
+        self.total = None
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    # Size of entry files in bytes, 0 if there is no such entry
+    def entry_size(self, entry):
+        try:
+            return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        except OSError:
+            return 0
+
+    def load(self, key):
+        """ Dictionary of name: array or None if not cached """
+        entry = self.entry_path(key)
+        try:
+            names = [name for name in os.listdir(entry) if name.endswith('.npy')]
+        except OSError:
+            return None
+
+        arrays = {}
+        for name in names:
+            array_path = os.path.join(entry, name)
+            if self.mmap_size is not None and os.path.getsize(array_path) > self.mmap_size:
+                mode = 'r'
+            else:
+                mode = None
+            arrays[name[:-4]] = np.load(array_path, mmap_mode=mode)
+
+        # Mark as recently used
+        os.utime(entry)
+        return arrays
+
+    def save(self, key, arrays):
+        os.makedirs(self.path, exist_ok=True)
+        entry = self.entry_path(key)
+
+        # Write to temporary directory and rename, so readers never see partial entries
+        tmp_entry = "%s.tmp%d" % (entry, os.getpid())
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp_entry, name + '.npy'), values)
+        size = self.entry_size(tmp_entry)
+
+        # Replaced entry does not count anymore
+        size -= self.entry_size(entry)
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Somebody else has just saved the same entry
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        if self.total is None or self.total + size > self.max_size:
+            self.evict(self.max_size * EVICT_TO)
+        else:
+            self.total += size
+
+    def evict(self, target_size=None):
+        """ Remove least recently used entries until cache fits target_size, max_size by default """
+        if target_size is None:
+            target_size = self.max_size
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            entry = self.entry_path(name)
+            # Skip entries being written
+            if '.tmp' in name:
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                # Removed by another process meanwhile
+                continue
+            total += size
+
+        if total > self.max_size:
+            for last_used, size, entry in sorted(entries):
+                if total <= target_size:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+        self.total = total
@@ -1,24 +1,415 @@
-import urllib.request
+import os
+import json
+import threading
+import http.client
+import urllib.parse
 import datetime as dt
 import time as t
+import concurrent.futures
 
 # Own package imports
 from . import basic as b
+from . import tickfile
+from . import tickstore
 
-def btccharts(from_time):
-    newest_timestamp = 0
-    new_data = []
-    # Fetch data while most recent data is not older than 10 minutes
+API_URL = "http://api.bitcoincharts.com/v1/trades.csv"
+
+# Stop downloading when newest trade is not older than that, seconds
+MAX_AGE = 600
+
+# Minimal interval between requests to the same host, seconds
+REQUEST_INTERVAL = 0.1
+
+
+class RateLimiter(object):
+    """ Spaces calls of wait() from any thread at least interval seconds apart """
+    def __init__(self, interval=REQUEST_INTERVAL):
+        self.interval = interval
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = t.monotonic()
+            delay = max(self.next_time - now, 0)
+            self.next_time = max(self.next_time, now) + self.interval
+        if delay > 0:
+            t.sleep(delay)
+
+
+# Rate limiters shared by all connections to the host
+host_limiters = {}
+host_limiters_lock = threading.Lock()
+
+
+def host_limiter(host):
+    with host_limiters_lock:
+        if host not in host_limiters:
+            host_limiters[host] = RateLimiter()
+        return host_limiters[host]
+
+
+class Connection(object):
+    """
+    Keep-alive HTTP connection to data source.
+    Reconnects once if connection was dropped by server.
+    Requests are rate limited per host unless other limiter is given.
+    """
+    def __init__(self, url=API_URL, timeout=60, limiter=None):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path
+        self.timeout = timeout
+        self.limiter = limiter or host_limiter(self.host)
+        self.conn = None
+
+    def request_lines(self, query):
+        """ Generator of response lines, read from socket as they arrive """
+        for attempt in (1, 2):
+            self.limiter.wait()
+            try:
+                if self.conn is None:
+                    self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                self.conn.request('GET', self.path + '?' + urllib.parse.urlencode(query))
+                response = self.conn.getresponse()
+                break
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt == 2:
+                    raise
+
+        if response.status != 200:
+            response.read()
+            raise http.client.HTTPException("%s returned %s %s" % (self.host, response.status, response.reason))
+
+        try:
+            for line in response:
+                line = line.strip()
+                if line:
+                    yield line.decode()
+        finally:
+            # Connection is reused for the next request only after response is closed
+            response.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+# Parse CSV line into (time, price, amount) tuple
+def trade(line):
+    time, price, amount = line.split(',')
+    return (int(time), float(price), float(amount))
+
+
+# Trades of the page at its last time
+def page_boundary(page):
+    last_time = trade(page[-1])[0]
+    boundary = []
+    for line in reversed(page):
+        values = trade(line)
+        if values[0] != last_time:
+            break
+        boundary.append(values)
+    return (last_time, boundary[::-1])
+
+
+def btccharts_pages(from_time, boundary=(), symbol='btceUSD', conn=None, end_time=None):
+    """
+    Generator of pages of trades from bitcoincharts.com, every page is a list of CSV lines.
+
+    Pages start at the time of the last received trade, so trades at that time
+    are received again. They are dropped if already known: boundary is a list
+    of (time, price, amount) tuples of trades at from_time received before.
+    Trades at end_time and later are not returned.
+    """
+    if conn is None:
+        conn = Connection()
+
+    boundary = list(boundary)
+    newest_timestamp = from_time
+    # Fetch data while most recent data is older than MAX_AGE
     # due to current limitation for bitcoincharts being 20000 rows at once
-    while b.now() - newest_timestamp > 600:
-        print("Getting data from bitcoincharts.com")
-        # Get latest data from Bitcoincharts
-        btcc_data = urllib.request.urlopen("http://api.bitcoincharts.com/v1/trades.csv?symbol=btceUSD&start=%d" % from_time)
-        # Form data list of all lines except the first one
-        new_data.extend(btcc_data.read().decode().split('\n')[1:])
-        newest_timestamp = int(new_data[-1].split(',')[0])
-        from_time = newest_timestamp
-        print("Got lines, last timestamp %s" % dt.datetime.fromtimestamp(newest_timestamp))
-        t.sleep(0.1)
+    while b.now() - newest_timestamp > MAX_AGE:
+        print("Getting %s data from bitcoincharts.com" % symbol)
+        page = []
+        finished = False
+        for line in conn.request_lines({'symbol': symbol, 'start': newest_timestamp}):
+            values = trade(line)
+            # Skip data which we already have
+            if values[0] < newest_timestamp:
+                continue
+            if values[0] == newest_timestamp and values in boundary:
+                boundary.remove(values)
+                continue
+            if end_time is not None and values[0] >= end_time:
+                finished = True
+                continue
+            page.append(line)
+
+        if not page:
+            break
+
+        # Trades at the newest time are the boundary of the next page
+        newest_timestamp, boundary = page_boundary(page)
+        print("Got %d lines of %s, last timestamp %s" % (len(page), symbol, dt.datetime.fromtimestamp(newest_timestamp)))
+
+        yield page
+
+        if finished:
+            break
+
+
+def btccharts(from_time, boundary=()):
+    """ Download all trades since from_time into memory, see btccharts_pages() for boundary """
+    new_data = []
+    newest_timestamp = from_time
+    for page in btccharts_pages(from_time, boundary):
+        new_data.extend(page)
+        newest_timestamp = trade(page[-1])[0]
 
     return (new_data, newest_timestamp)
+
+
+class CsvTarget(object):
+    """ CSV file to append downloaded trades to """
+    def __init__(self, path):
+        self.path = path
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def truncate(self, size):
+        with open(self.path, 'r+b') as f:
+            f.truncate(size)
+
+    def boundary(self):
+        """ Last trade time and all trades at that time """
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            # Read back from the end till a trade before the last second is found
+            offset = 4096
+            while True:
+                start = max(end - offset, 0)
+                f.seek(start)
+                lines = f.read(end - start).decode().strip().split('\n')
+                # First line may be incomplete
+                if start > 0:
+                    lines = lines[1:]
+
+                trades = [trade(line) for line in lines]
+                last_time = trades[-1][0]
+                if start == 0 or trades[0][0] != last_time:
+                    break
+                offset *= 2
+
+        return (last_time, [values for values in trades if values[0] == last_time])
+
+    def append(self, lines):
+        with open(self.path, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            # Finish last line if needed
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+            f.write(('\n'.join(lines) + '\n').encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class StoreTarget(object):
+    """ Tick store to append downloaded trades to """
+    def __init__(self, path):
+        self.store = tickstore.TickStore(path)
+
+    def size(self):
+        return self.store.rows
+
+    def truncate(self, size):
+        self.store.truncate(size)
+
+    def boundary(self):
+        """ Last trade time and all trades at that time """
+        time = self.store.time
+        last_time = int(time[-1])
+        # Trades of the last second are at the end
+        first = len(time) - 1
+        while first > 0 and time[first - 1] == last_time:
+            first -= 1
+        trades = zip(time[first:].tolist(), self.store.price[first:].tolist(), self.store.amount[first:].tolist())
+        return (last_time, list(trades))
+
+    def append(self, lines):
+        self.store.append(*tickfile.parse_lines('\n'.join(lines).encode()))
+
+
+class Checkpoint(object):
+    """
+    Download progress saved before the first and after every written page:
+    target size, last trade time and trades at that time
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        state['boundary'] = [tuple(values) for values in state['boundary']]
+        return state
+
+    def save(self, size, last_time, boundary):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': size, 'last_time': last_time, 'boundary': boundary}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def download(target, checkpoint, symbol='btceUSD', conn=None, end_time=None):
+    """
+    Append new trades to target page by page as they arrive.
+    Interrupted download is resumed from checkpoint, anything
+    written after it is dropped and downloaded again.
+    Returns number of written lines and the newest timestamp.
+    """
+    state = checkpoint.load()
+    if state is not None:
+        print("Resuming interrupted download")
+        target.truncate(state['size'])
+        last_time, boundary = state['last_time'], state['boundary']
+    else:
+        last_time, boundary = target.boundary()
+        # Interrupted first page is dropped too
+        checkpoint.save(target.size(), last_time, boundary)
+
+    print("Last available point is at %s" % dt.datetime.fromtimestamp(last_time))
+
+    count = 0
+    for page in btccharts_pages(last_time, boundary, symbol, conn, end_time):
+        target.append(page)
+        count += len(page)
+        last_time, boundary = page_boundary(page)
+        checkpoint.save(target.size(), last_time, boundary)
+
+    checkpoint.remove()
+    return (count, last_time)
+
+
+# Split [start, end) into number of equal time ranges
+def time_ranges(start, end, number):
+    bounds = [start + (end - start) * i // number for i in range(number + 1)]
+    return [(first, last) for first, last in zip(bounds[:-1], bounds[1:]) if first < last]
+
+
+class Fetcher(object):
+    """
+    Downloads trades of many symbols concurrently by a pool of threads.
+    Every symbol is kept in its own tick store <directory>/<symbol>.store.
+
+    Existing stores are updated from their last trade by download(), so
+    the update can be resumed. Stores which do not exist yet are filled
+    from from_time: the period is split into time ranges, every range is
+    fetched to a temporary CSV file and files are appended to the store in order.
+
+    Every thread keeps its own keep-alive connection, all connections share
+    one rate limiter as they go to the same host.
+    """
+    def __init__(self, directory, url=API_URL, jobs=8, interval=REQUEST_INTERVAL):
+        self.directory = directory
+        self.url = url
+        self.jobs = jobs
+        self.limiter = RateLimiter(interval)
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def store_path(self, symbol):
+        return os.path.join(self.directory, symbol + '.store')
+
+    def connection(self):
+        """ Connection of the current thread """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = Connection(self.url, limiter=self.limiter)
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def update(self, symbol, end_time=None):
+        """ Append new trades to existing store """
+        path = self.store_path(symbol)
+        target = StoreTarget(path)
+        checkpoint = Checkpoint(path + '.download')
+        return download(target, checkpoint, symbol, self.connection(), end_time)
+
+    def fetch_range(self, symbol, part_path, start, end):
+        """ Write trades from start till end to CSV file """
+        open(part_path, 'wb').close()
+        target = CsvTarget(part_path)
+        count = 0
+        for page in btccharts_pages(start, (), symbol, self.connection(), end):
+            target.append(page)
+            count += len(page)
+        return count
+
+    def merge(self, symbol, part_paths):
+        """ Append fetched ranges to new store and remove them """
+        path = self.store_path(symbol)
+        if tickstore.is_store(path):
+            store = tickstore.TickStore(path)
+        else:
+            store = tickstore.TickStore.create(path)
+        for part_path in part_paths:
+            for time, price, amount in tickfile.read_chunks(part_path):
+                store.append(time, price, amount)
+            os.remove(part_path)
+        return store.last_time
+
+    def run(self, symbols, from_time=None, end_time=None, ranges=1):
+        """
+        Update or create stores of all symbols.
+        Returns dict of symbol: (number of new trades, last trade time)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if end_time is None:
+            end_time = b.now()
+
+        existing = [symbol for symbol in symbols if tickstore.is_store(self.store_path(symbol))
+                    and tickstore.TickStore(self.store_path(symbol)).rows > 0]
+        new = [symbol for symbol in symbols if symbol not in existing]
+        if new and from_time is None:
+            raise ValueError("No data for %s and no start time given" % ','.join(new))
+
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            updates = dict((symbol, pool.submit(self.update, symbol, end_time)) for symbol in existing)
+            parts = {}
+            for symbol in new:
+                parts[symbol] = []
+                for i, (first, last) in enumerate(time_ranges(from_time, end_time, ranges)):
+                    part_path = self.store_path(symbol) + '.part%d' % i
+                    parts[symbol].append((part_path, pool.submit(self.fetch_range, symbol, part_path, first, last)))
+
+            for symbol, future in updates.items():
+                results[symbol] = future.result()
+
+            for symbol, symbol_parts in parts.items():
+                count = sum(future.result() for part_path, future in symbol_parts)
+                results[symbol] = (count, self.merge(symbol, [part_path for part_path, future in symbol_parts]))
+
+        for conn in self.connections:
+            conn.close()
+        return results
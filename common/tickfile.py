@@ -0,0 +1,249 @@
+import os
+
+import numpy as np
+
+# Own package imports
+from . import tickindex
+
+"""
+Bulk readers for bitcoincharts CSV files
+Columns must be: timestamp,price,amount
+"""
+
+# How much bytes to parse at once
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Index sidecar file is <CSV file><INDEX_SUFFIX>
+INDEX_SUFFIX = '.idx'
+
+
+# Parse block of complete CSV lines into (time, price, amount) arrays
+def parse_lines(raw_data):
+    raw_data = raw_data.rstrip()
+    if not raw_data:
+        empty = np.empty(0)
+        return (empty.astype(np.int64), empty, empty)
+
+    # Newlines become separators as well, so the whole block
+    # is parsed as one flat list of numbers
+    values = np.fromstring(raw_data.replace(b'\n', b','), sep=',')
+    if len(values) % 3 != 0:
+        raise ValueError("Malformed CSV data: expected 3 columns per line")
+    values = values.reshape(-1, 3)
+
+    # Timestamps are small enough to be exact in double
+    return (values[:, 0].astype(np.int64), values[:, 1].copy(), values[:, 2].copy())
+
+
+# Read file in blocks of complete lines, not more than limit bytes if given
+def read_blocks(f, chunk_size=CHUNK_SIZE, limit=None):
+    rest = b''
+    while True:
+        if limit is not None:
+            chunk_size = min(chunk_size, limit)
+            limit -= chunk_size
+        block = f.read(chunk_size)
+        if not block:
+            break
+        block = rest + block
+        # Cut on the last complete line, keep the tail for next block
+        cut = block.rfind(b'\n') + 1
+        if cut == 0:
+            rest = block
+            continue
+        rest = block[cut:]
+        yield block[:cut]
+
+    if rest:
+        yield rest
+
+
+# Cut (time, price, amount) arrays to the given time window
+def window_filter(time, price, amount, lookback_time, endtime):
+    """
+    Returns filtered arrays, flag showing that endtime was reached
+    and number of given rows read, the rest is after endtime.
+    Arrays are returned untouched (no copy) if all rows fit.
+    """
+    mask = time > lookback_time
+
+    finished = False
+    read = len(time)
+    if endtime is not None:
+        past_end = np.flatnonzero(mask & (time >= endtime))
+        if len(past_end):
+            read = past_end[0] + 1
+            time, price, amount, mask = time[:read], price[:read], amount[:read], mask[:read]
+            finished = True
+
+    if not mask.all():
+        time, price, amount = time[mask], price[mask], amount[mask]
+
+    return ((time, price, amount), finished, read)
+
+
+# Generator of (time, price, amount) arrays for the given time window
+def read_chunks(path, lookback_time=0, endtime=None, chunk_size=CHUNK_SIZE):
+    """
+    Rows with timestamp not greater than lookback_time are skipped.
+    Reading stops right after the first row at or past endtime,
+    that row is still returned.
+    Index sidecar is used to skip parts of file outside of the window.
+    """
+    for time, price, amount, next_row in read_rows(path, lookback_time, endtime, chunk_size=chunk_size):
+        yield (time, price, amount)
+
+
+def read_rows(path, lookback_time=0, endtime=None, first_row=None, chunk_size=CHUNK_SIZE):
+    """
+    Same as read_chunks(), but every chunk comes with number of the row after
+    the last one read, so reading can be continued from it later.
+    first_row - number of row to start reading from instead of seeking to lookback_time
+    """
+    start, row, limit = 0, 0, None
+    index = load_csv_index(path)
+    if index is not None:
+        if first_row is None:
+            entry = index.seek(lookback_time)
+            stop = index.stop(lookback_time, endtime)
+            if stop is not None:
+                limit = stop - int(entry['offset'])
+        else:
+            entry = index.entries[max(np.searchsorted(index.entries['row'], first_row, side='right') - 1, 0)]
+        start, row = int(entry['offset']), int(entry['row'])
+
+    # Rows before the first one are read, but not returned
+    skip = max((first_row or 0) - row, 0)
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        for block in read_blocks(f, chunk_size, limit):
+            time, price, amount = parse_lines(block)
+            if skip:
+                skipped = min(skip, len(time))
+                time, price, amount = time[skipped:], price[skipped:], amount[skipped:]
+                skip -= skipped
+                row += skipped
+
+            (time, price, amount), finished, read = window_filter(time, price, amount, lookback_time, endtime)
+            row += read
+
+            if len(time):
+                yield (time, price, amount, row)
+
+            if finished:
+                break
+
+
+# Index of CSV file
+def csv_index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def load_csv_index(path):
+    """ Index of the CSV file or None if missing or outdated """
+    try:
+        with open(csv_index_path(path), 'rb') as f:
+            saved = np.load(f)
+            entries, size, mtime = saved['entries'], int(saved['size']), int(saved['mtime'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+    stat = os.stat(path)
+    if stat.st_size != size or stat.st_mtime_ns != mtime:
+        return None
+
+    return tickindex.TickIndex(entries)
+
+
+def max_time(path):
+    """ Highest timestamp in CSV file if known from index, otherwise None """
+    index = load_csv_index(path)
+    if index is None:
+        return None
+    return int(index.entries['max_time'][-1])
+
+
+def save_csv_index(path, index):
+    stat = os.stat(path)
+    tmp_path = csv_index_path(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, entries=index.entries, size=stat.st_size, mtime=stat.st_mtime_ns)
+    os.replace(tmp_path, csv_index_path(path))
+
+
+def index_csv(path, index=None):
+    """
+    Index CSV file, continuing from the given index if it
+    covers beginning of the file
+    """
+    if index is None:
+        index = tickindex.TickIndex()
+
+    with open(path, 'rb') as f:
+        offset = index.end
+        f.seek(offset)
+        # Appended data may start with newline ending the last indexed line
+        if f.read(1) == b'\n':
+            offset += 1
+        f.seek(offset)
+        for block in read_blocks(f):
+            time = parse_lines(block)[0]
+            # Offsets of line starts within the block
+            starts = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')) + 1
+            starts = np.concatenate(([0], starts))[:len(time)] + offset
+            offset += len(block)
+            index.extend(time, starts, offset)
+
+    return index
+
+
+def index_matches(path, index):
+    """
+    Check that file still starts with data the index was built of:
+    rows after the last but one entry are read again and compared with it
+    """
+    if len(index.entries) < 2:
+        return index.end == 0
+    first, last = index.entries[-2], index.entries[-1]
+    start = max(int(first['offset']) - 1, 0)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        block = f.read(int(last['offset']) - start)
+    if len(block) != int(last['offset']) - start:
+        return False
+    # Entry has to be at the start of line
+    if first['offset'] > 0:
+        if block[:1] != b'\n':
+            return False
+        block = block[1:]
+
+    try:
+        time = parse_lines(block)[0]
+    except ValueError:
+        return False
+    return (len(time) == last['row'] - first['row'] and len(time) > 0
+            and max(int(first['max_time']), int(time.max())) == last['max_time'])
+
+
+def update_csv_index(path):
+    """
+    Update index of CSV file after appending to it.
+    Index is built from scratch when missing, longer than
+    file or when file does not start with indexed data.
+    """
+    index = None
+    try:
+        with open(csv_index_path(path), 'rb') as f:
+            saved = np.load(f)
+            if int(saved['size']) <= os.path.getsize(path):
+                index = tickindex.TickIndex(saved['entries'])
+    except (OSError, KeyError, ValueError):
+        pass
+
+    if index is not None and not index_matches(path, index):
+        index = None
+
+    index = index_csv(path, index)
+    save_csv_index(path, index)
+    return index
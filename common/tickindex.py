@@ -0,0 +1,83 @@
+import numpy as np
+
+"""
+Sparse timestamp index of tick data
+
+Every STEP rows an entry is recorded with the row number, its position
+(byte offset for CSV files, row for tick stores) and the highest timestamp
+of all rows before it. As bitcoincharts files are not always in order,
+the running maximum is what makes seeking safe: everything before an entry
+whose maximum is not above lookback time would be filtered out anyway.
+"""
+
+# Rows between index entries
+STEP = 16384
+
+ENTRY = np.dtype([('row', '<i8'), ('offset', '<i8'), ('max_time', '<i8')])
+
+
+class TickIndex(object):
+    """
+    Structure:
+
+    Array of entries (row, offset, max_time), last entry
+    always points to the end of indexed data.
+    """
+    def __init__(self, entries=None):
+        if entries is None:
+            # Nothing before the first row
+            entries = np.array([(0, 0, -1)], dtype=ENTRY)
+        self.entries = entries
+
+    @property
+    def rows(self):
+        return int(self.entries['row'][-1])
+
+    @property
+    def end(self):
+        return int(self.entries['offset'][-1])
+
+    def extend(self, time, offsets, end):
+        """
+        Add rows which follow already indexed data.
+        offsets - positions of the given rows, end - position after them
+        """
+        if len(time) == 0:
+            return
+
+        last = self.entries[-1]
+        first_row = int(last['row'])
+
+        # Highest timestamp before every given row
+        max_before = np.empty(len(time), dtype=np.int64)
+        max_before[0] = last['max_time']
+        np.maximum.accumulate(time[:-1], out=max_before[1:])
+        np.maximum(max_before, last['max_time'], out=max_before)
+
+        rows = np.arange(first_row, first_row + len(time))
+        keep = rows % STEP == 0
+        # Previous end entry is replaced with a regular one if it falls on a step
+        new_entries = np.empty(keep.sum() + 1, dtype=ENTRY)
+        new_entries['row'][:-1] = rows[keep]
+        new_entries['offset'][:-1] = np.asarray(offsets)[keep]
+        new_entries['max_time'][:-1] = max_before[keep]
+        new_entries[-1] = (first_row + len(time), end, max(int(last['max_time']), int(time.max())))
+
+        self.entries = np.concatenate((self.entries[:-1], new_entries))
+
+    def seek(self, lookback_time):
+        """ Entry to start reading from for rows newer than lookback_time """
+        i = np.searchsorted(self.entries['max_time'], lookback_time, side='right') - 1
+        return self.entries[max(i, 0)]
+
+    def stop(self, lookback_time, endtime):
+        """
+        Position at which first row at or past endtime is already read.
+        None if it can be anywhere in the rest of data.
+        """
+        if endtime is None:
+            return None
+        i = np.searchsorted(self.entries['max_time'], max(endtime, lookback_time + 1), side='left')
+        if i >= len(self.entries):
+            return None
+        return int(self.entries[i]['offset'])
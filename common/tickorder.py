@@ -0,0 +1,196 @@
+import os
+import heapq
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+# Own package imports
+from . import tickfile
+
+"""
+Check and repair order of ticks in CSV file
+
+Row is in place when it is not lower than any row before it and not
+higher than any row after it. Runs of rows which are not in place are
+disruption regions: sorting every region on its own sorts the whole file.
+"""
+
+# How much bytes every worker parses at once
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# Split file into byte ranges ending on line ends
+def chunk_ranges(path, chunk_size=CHUNK_SIZE):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        while bounds[-1] + chunk_size < size:
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Timestamps and line start offsets of byte range
+def read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        block = f.read(end - start)
+    time = tickfile.parse_lines(block)[0]
+    starts = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')) + 1
+    starts = np.concatenate(([0], starts))[:len(time)] + start
+    return (time, starts)
+
+
+# Number of rows, lowest and highest timestamp of byte range
+def range_summary(task):
+    path, start, end = task
+    time = read_range(path, start, end)[0]
+    if len(time) == 0:
+        return (0, np.inf, -np.inf)
+    return (len(time), time.min(), time.max())
+
+
+# Disruption regions of byte range
+def range_regions(task):
+    """
+    max_before and min_after are the highest timestamp before the range
+    and the lowest after it. Returns list of regions, every region is a
+    list of [first row, last row, start offset, end offset, lowest time, highest time]
+    """
+    path, start, end, first_row, max_before, min_after = task
+    time, starts = read_range(path, start, end)
+    if len(time) == 0:
+        return []
+
+    highest_before = np.empty(len(time))
+    highest_before[0] = max_before
+    np.maximum.accumulate(time[:-1], out=highest_before[1:])
+    np.maximum(highest_before, max_before, out=highest_before)
+
+    lowest_after = np.empty(len(time))
+    lowest_after[-1] = min_after
+    lowest_after[:-1] = np.minimum.accumulate(time[:0:-1])[::-1]
+    np.minimum(lowest_after, min_after, out=lowest_after)
+
+    misplaced = (time < highest_before) | (time > lowest_after)
+
+    # Runs of misplaced rows
+    edges = np.diff(np.concatenate(([0], misplaced.view(np.int8), [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+
+    regions = []
+    for first, last in zip(run_starts, run_ends):
+        end_offset = starts[last] if last < len(time) else end
+        regions.append([first_row + first, first_row + last - 1, int(starts[first]), int(end_offset),
+                        time[first:last].min(), time[first:last].max()])
+    return regions
+
+
+def find_regions(path, jobs=None):
+    """ List of disruption regions of the file, see range_regions() """
+    ranges = chunk_ranges(path)
+
+    with multiprocessing.Pool(jobs) as pool:
+        summaries = pool.map(range_summary, [(path, start, end) for start, end in ranges])
+
+        rows = np.array([summary[0] for summary in summaries])
+        lows = np.array([summary[1] for summary in summaries], dtype=np.float64)
+        highs = np.array([summary[2] for summary in summaries], dtype=np.float64)
+
+        # Highest timestamp before and lowest timestamp after every range
+        first_rows = np.cumsum(rows) - rows
+        max_before = np.maximum.accumulate(np.concatenate(([-np.inf], highs[:-1])))
+        min_after = np.minimum.accumulate(np.concatenate((lows[:0:-1], [np.inf])))[::-1]
+
+        tasks = [(path, start, end, first_row, before, after) for (start, end), first_row, before, after
+                 in zip(ranges, first_rows, max_before, min_after)]
+        range_results = pool.map(range_regions, tasks)
+
+    # Join regions continuing over range borders
+    regions = []
+    for region in (region for result in range_results for region in result):
+        if regions and regions[-1][3] == region[2]:
+            last = regions[-1]
+            regions[-1] = [last[0], region[1], last[2], region[3],
+                           min(last[4], region[4]), max(last[5], region[5])]
+        else:
+            regions.append(region)
+
+    return regions
+
+
+# Copy bytes range from one file to another
+def copy_range(src, dst, start, end):
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = src.read(min(CHUNK_SIZE, remaining))
+        if not block:
+            break
+        dst.write(block)
+        remaining -= len(block)
+
+
+# Lines of block stably sorted by timestamp
+def sort_lines(block):
+    lines = block.rstrip(b'\n').split(b'\n')
+    order = np.argsort(tickfile.parse_lines(block)[0], kind='mergesort')
+    return [lines[i] for i in order]
+
+
+def fix_regions(path, out_path, regions):
+    """ Sort every region in memory, copy the rest of file as is """
+    with open(path, 'rb') as src, open(out_path, 'wb') as dst:
+        position = 0
+        for region in regions:
+            start, end = region[2], region[3]
+            copy_range(src, dst, position, start)
+            src.seek(start)
+            dst.write(b'\n'.join(sort_lines(src.read(end - start))) + b'\n')
+            position = end
+        copy_range(src, dst, position, os.path.getsize(path))
+
+
+def external_sort(path, out_path, memory):
+    """ Merge sort of file keeping not more than memory bytes of lines at once """
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_path)))
+    try:
+        # Sorted runs
+        runs = []
+        with open(path, 'rb') as f:
+            for block in tickfile.read_blocks(f, max(memory // 4, 1024)):
+                run_path = os.path.join(tmp_dir, 'run%d' % len(runs))
+                with open(run_path, 'wb') as run:
+                    run.write(b'\n'.join(sort_lines(block)) + b'\n')
+                runs.append(run_path)
+
+        # Merge is stable: equal timestamps keep order of runs
+        run_files = [open(run_path, 'rb') for run_path in runs]
+        try:
+            with open(out_path, 'wb') as dst:
+                dst.writelines(heapq.merge(*run_files, key=lambda line: float(line.split(b',', 1)[0])))
+        finally:
+            for run in run_files:
+                run.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def fix_order(path, out_path, regions, memory):
+    """
+    Write sorted copy of file. Regions are sorted in place when every
+    one of them fits memory, otherwise whole file is merge sorted
+    """
+    if max(region[3] - region[2] for region in regions) * 4 <= memory:
+        print("Sorting %d regions" % len(regions))
+        fix_regions(path, out_path, regions)
+    else:
+        print("Regions do not fit memory, sorting whole file")
+        external_sort(path, out_path, memory)
@@ -0,0 +1,199 @@
+import os
+import configparser
+
+import numpy as np
+
+# Own package imports
+from . import tickfile
+from . import tickindex
+
+"""
+Binary columnar storage of ticks
+
+Store is a directory with one raw little-endian file per column
+plus a small header. Columns are read through memory maps, so
+reading does not copy data and concurrent readers share page cache.
+"""
+
+# Column name: data type
+COLUMNS = (('time', '<i8'), ('price', '<f8'), ('amount', '<f8'))
+
+# Rows to hand out at once when reading by chunks
+CHUNK_ROWS = 1024 * 1024
+
+HEADER = 'header'
+INDEX = 'index.npy'
+VERSION = 1
+
+
+# Check if path looks like a tick store
+def is_store(path):
+    return os.path.isfile(os.path.join(path, HEADER))
+
+
+class TickStore(object):
+    """
+    Structure:
+
+    Directory:
+        header - ini file with format version and number of rows
+        time.bin - timestamps, int64
+        price.bin - prices, double
+        amount.bin - amounts, double
+        index.npy - sparse timestamp index, see tickindex
+
+    Number of rows in header is the commit point. Columns may be longer
+    after an interrupted append, such tails are ignored and overwritten.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not is_store(path):
+            raise FileNotFoundError("%s is not a tick store" % path)
+        self.read_header()
+
+    @classmethod
+    def create(cls, path):
+        os.makedirs(path, exist_ok=True)
+        for name, dtype in COLUMNS:
+            open(cls.column_path(path, name), 'wb').close()
+        cls.write_header(path, 0, 0)
+        return cls(path)
+
+    @staticmethod
+    def column_path(path, name):
+        return os.path.join(path, name + '.bin')
+
+    @staticmethod
+    def write_header(path, rows, last_time):
+        header = configparser.ConfigParser()
+        header['store'] = {'version': VERSION, 'rows': rows, 'last_time': last_time}
+        # Write to temporary file and move to make update atomic
+        tmp_path = os.path.join(path, HEADER + '.tmp')
+        with open(tmp_path, 'w') as f:
+            header.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(path, HEADER))
+
+    def read_header(self):
+        header = configparser.ConfigParser()
+        header.read(os.path.join(self.path, HEADER))
+        if int(header['store']['version']) != VERSION:
+            raise ValueError("Unsupported tick store version in %s" % self.path)
+        self.rows = int(header['store']['rows'])
+        self.last_time = int(header['store']['last_time'])
+
+    def column(self, name):
+        """ Read-only memory map of the column """
+        dtype = dict(COLUMNS)[name]
+        if self.rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.column_path(self.path, name), dtype=dtype, mode='r', shape=(self.rows,))
+
+    @property
+    def time(self):
+        return self.column('time')
+
+    @property
+    def price(self):
+        return self.column('price')
+
+    @property
+    def amount(self):
+        return self.column('amount')
+
+    def append(self, time, price, amount):
+        assert len(time) == len(price) == len(amount)
+        if len(time) == 0:
+            return
+
+        for (name, dtype), values in zip(COLUMNS, (time, price, amount)):
+            with open(self.column_path(self.path, name), 'r+b') as f:
+                # Drop leftovers of interrupted appends
+                f.truncate(self.rows * np.dtype(dtype).itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        index = self.index()
+        index.extend(np.asarray(time, dtype=np.int64), np.arange(self.rows, self.rows + len(time)),
+                     self.rows + len(time))
+        self.save_index(index)
+
+        self.write_header(self.path, self.rows + len(time), int(time[-1]))
+        self.read_header()
+
+    def truncate(self, rows):
+        """ Drop rows after the given number """
+        if rows >= self.rows:
+            return
+        last_time = int(self.time[rows - 1]) if rows > 0 else 0
+        self.write_header(self.path, rows, last_time)
+        self.read_header()
+
+    def index(self):
+        """ Sparse index of rows, rebuilt if not matching the data """
+        try:
+            entries = np.load(os.path.join(self.path, INDEX))
+        except (OSError, ValueError):
+            entries = None
+
+        index = tickindex.TickIndex(entries)
+        if index.rows != self.rows:
+            index = tickindex.TickIndex()
+            index.extend(np.asarray(self.time), np.arange(self.rows), self.rows)
+            self.save_index(index)
+        return index
+
+    @property
+    def max_time(self):
+        """ Highest timestamp in store """
+        return int(self.index().entries['max_time'][-1])
+
+    def save_index(self, index):
+        tmp_path = os.path.join(self.path, INDEX + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, index.entries)
+        os.replace(tmp_path, os.path.join(self.path, INDEX))
+
+    def read_chunks(self, lookback_time=0, endtime=None, chunk_rows=CHUNK_ROWS):
+        """
+        Same as tickfile.read_chunks(), but chunks are views
+        of memory mapped columns when no rows are filtered out.
+        """
+        for time, price, amount, next_row in self.read_rows(lookback_time, endtime, chunk_rows=chunk_rows):
+            yield (time, price, amount)
+
+    def read_rows(self, lookback_time=0, endtime=None, first_row=None, chunk_rows=CHUNK_ROWS):
+        """ Same as tickfile.read_rows() """
+        time, price, amount = self.time, self.price, self.amount
+
+        # Skip rows outside of the window using index
+        if first_row is None:
+            index = self.index()
+            first_row = int(index.seek(lookback_time)['offset'])
+            last_row = index.stop(lookback_time, endtime)
+        else:
+            last_row = None
+        if last_row is None:
+            last_row = self.rows
+
+        for start in range(first_row, last_row, chunk_rows):
+            chunk = slice(start, min(start + chunk_rows, last_row))
+            (t, p, a), finished, read = tickfile.window_filter(time[chunk], price[chunk], amount[chunk],
+                                                               lookback_time, endtime)
+            if len(t):
+                yield (t, p, a, start + read)
+
+            if finished:
+                break
+
+
+# Build store from CSV file
+def from_csv(csv_path, store_path):
+    store = TickStore.create(store_path)
+    for time, price, amount in tickfile.read_chunks(csv_path):
+        store.append(time, price, amount)
+        print("Row: %s" % store.rows)
+    return store
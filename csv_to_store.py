@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import sys
+
+# Own package imports
+from common import tickstore
+
+"""
+Convert bitcoincharts CSV file to binary tick store
+which can be used as input by backtest.py, bot.py and get_data.py
+"""
+
+aparser = argparse.ArgumentParser()
+aparser.add_argument('-f', dest='datafile_path', required=True, help='CSV file to convert')
+aparser.add_argument('-o', dest='store_path', help='Tick store directory to create. Default: <CSV file>.store')
+args = aparser.parse_args()
+
+store_path = args.store_path or args.datafile_path + '.store'
+if os.path.exists(store_path):
+    print("Error: %s already exists." % store_path)
+    sys.exit(1)
+
+store = tickstore.from_csv(args.datafile_path, store_path)
+print("Wrote %s rows to %s" % (store.rows, store_path))
@@ -3,54 +3,48 @@
 import argparse
 import os
 import sys
-import urllib.request
 import datetime as dt
 
 # Own package imports
 from common import datadownload
+from common import tickfile
+from common import tickstore
 
 """
 This script gets the last data from bitcoincharts.com
 and appends it to existing CSV file from the same site
+or to tick store built from such file
+
+Every downloaded page is written at once and progress is saved
+to <file>.download, so interrupted download continues from there
 """
 
 aparser = argparse.ArgumentParser()
-aparser.add_argument('-f', dest='datafile_path', required=True, help='CSV file to work on')
+aparser.add_argument('-f', dest='datafile_path', required=True, help='CSV file or tick store to work on')
+aparser.add_argument('--url', dest='url', default=datadownload.API_URL, help='Trades API URL. Default: %(default)s')
 args = aparser.parse_args()
 
-# Determine latest timestamp in our datafile
-with open(args.datafile_path, 'rb') as f:
-    offset = 100 # How much bytes to read from the end of file
-    f.seek(0, os.SEEK_END)
-    fsize = f.tell()
-    if fsize == 0:
-        print("Error: file is empty.")
-        sys.exit(1)
-
-    # Read from the end and split into lines
-    f.seek(-1*offset, os.SEEK_END)
-    raw_data = f.read().decode()
-    lines = raw_data.split('\n')
-    # Get last line
-    last_line = lines[-1]
-    # If last line is empty
-    if last_line == "":
-        last_line = lines[-2]
-        newline_before = False
-    else:
-        newline_before = True
-    last_timestamp = int(last_line.split(',')[0])
-    print("Last available point is at %s" % dt.datetime.fromtimestamp(last_timestamp))
-
-new_data, newest_timestamp = datadownload.btccharts(last_timestamp)
-
-# Append data to file
-print("Appending %s lines to file. Last point is at %s" % (len(new_data), dt.datetime.fromtimestamp(newest_timestamp)))
-
-with open(args.datafile_path, 'a') as f:
-    for line in new_data:
-        if newline_before:
-            f.write("\n"+line)
-        else:
-            f.write(line+"\n")
+store_mode = tickstore.is_store(args.datafile_path)
+
+if store_mode:
+    target = datadownload.StoreTarget(args.datafile_path)
+else:
+    target = datadownload.CsvTarget(args.datafile_path)
+
+if target.size() == 0:
+    print("Error: %s is empty." % ("store" if store_mode else "file"))
+    sys.exit(1)
+
+checkpoint = datadownload.Checkpoint(os.path.normpath(args.datafile_path) + '.download')
+conn = datadownload.Connection(args.url)
+try:
+    count, newest_timestamp = datadownload.download(target, checkpoint, conn=conn)
+finally:
+    conn.close()
+
+print("Appended %s lines. Last point is at %s" % (count, dt.datetime.fromtimestamp(newest_timestamp)))
 
+if not store_mode:
+    # Keep timestamp index in sync
+    print("Updating index")
+    tickfile.update_csv_index(args.datafile_path)
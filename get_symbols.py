@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+
+import argparse
+import sys
+import datetime as dt
+
+# Own package imports
+from common.basic import *
+from common import datadownload
+
+"""
+This script downloads trades of many symbols from bitcoincharts.com at once.
+Every symbol is kept in its own tick store <directory>/<symbol>.store:
+existing stores get new data appended, missing ones are filled from --start.
+"""
+
+aparser = argparse.ArgumentParser()
+aparser.add_argument('-s', '--symbols', dest='symbols', required=True, help='Comma separated symbols, e.g. btceUSD,bitstampUSD')
+aparser.add_argument('-d', '--directory', dest='directory', default='data', help='Directory with tick stores. Default: %(default)s')
+aparser.add_argument('--start', dest='startdate', help='Date to get data from for symbols without store. Format: dd.mm.yy')
+aparser.add_argument('--end', dest='enddate', help='Date to get data till. Format: dd.mm.yy. Default: now')
+aparser.add_argument('-r', '--ranges', dest='ranges', type=int, default=1, help='Number of time ranges to download new symbol by at once. Default: %(default)s')
+aparser.add_argument('-j', '--jobs', dest='jobs', type=int, default=8, help='Number of simultaneous downloads. Default: %(default)s')
+aparser.add_argument('--interval', dest='interval', type=float, default=datadownload.REQUEST_INTERVAL,
+                     help='Minimal interval between requests, seconds. Default: %(default)s')
+aparser.add_argument('--url', dest='url', default=datadownload.API_URL, help='Trades API URL. Default: %(default)s')
+args = aparser.parse_args()
+
+from_time = None
+if args.startdate:
+    from_time = dt_timestamp(dt.datetime.strptime(args.startdate, '%d.%m.%y'))
+
+end_time = None
+if args.enddate:
+    end_time = dt_timestamp(dt.datetime.strptime(args.enddate, '%d.%m.%y'))
+
+fetcher = datadownload.Fetcher(args.directory, args.url, args.jobs, args.interval)
+try:
+    results = fetcher.run(args.symbols.split(','), from_time, end_time, args.ranges)
+except ValueError as e:
+    print("Error: %s" % e)
+    sys.exit(1)
+
+for symbol, (count, last_time) in sorted(results.items()):
+    print("%s: %s new lines. Last point is at %s" % (symbol, count, dt_date(last_time)))
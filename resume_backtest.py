@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import glob
+import argparse
+
+import datetime as dt
+
+# Own package imports
+from analysis.analysis import *
+from analysis import checkpoint
+from analysis import report
+from common.basic import *
+from common import tickfile
+from common import tickstore
+
+"""
+
+Script to continue backtest runs saved by backtest.py --checkpoint
+on ticks appended to data after them. Only new bars are tested,
+results are the same as backtest of all data would give.
+Every row appended after checkpoint is taken, also trades at its last second.
+Checkpoints are updated, plots and stats are made as by backtest.py
+
+"""
+
+aparser = argparse.ArgumentParser()
+aparser.add_argument('-i', '--input', dest='datafile_path', required=True, help='CSV file or tick store the checkpointed runs took data from')
+aparser.add_argument('-c', '--checkpoint', dest='checkpoint_dir', required=True, help='Directory of checkpoints saved by backtest.py --checkpoint')
+aparser.add_argument('-e', '--end', dest='enddate', help='Date to finish analysis at. Format: dd.mm.yy')
+aparser.add_argument('--ledger', dest='save_ledger', action='store_true', help='Save trades of every pair to ledger-<run> <period>.npz')
+aparser.add_argument('--save-results', dest='save_results', action='store_true', help='Save results to results-<run> <period>.npz to plot and write stats later by show_results.py')
+aparser.add_argument('--no-plot', dest='do_plot', action='store_false', help='Do not draw plots, just show text stats')
+aparser.set_defaults(do_plot=True, save_ledger=False, save_results=False)
+args = aparser.parse_args()
+
+if args.enddate:
+    end = dt.datetime.strptime(args.enddate, '%d.%m.%y')
+    endtime = int(end.strftime('%s'))
+else:
+    endtime = now()
+
+# Checkpoints by run name
+paths = {}
+checkpoints = {}
+for path in sorted(glob.glob(os.path.join(args.checkpoint_dir, '*.npz'))):
+    print ("Loading %s" % path)
+    run_checkpoint = checkpoint.Checkpoint.load(path)
+    paths[run_checkpoint.analytics.resolution] = path
+    checkpoints[run_checkpoint.analytics.resolution] = run_checkpoint
+
+if not checkpoints:
+    print ("Error: no checkpoints in %s" % args.checkpoint_dir)
+    sys.exit(1)
+
+# Rows after the ones every checkpoint has read, checkpoints made by one run read the same rows
+if tickstore.is_store(args.datafile_path):
+    source = tickstore.TickStore(args.datafile_path)
+else:
+    source = None
+
+for next_row in sorted(set(run_checkpoint.next_row for run_checkpoint in checkpoints.values())):
+    group = [run_checkpoint for run_checkpoint in checkpoints.values() if run_checkpoint.next_row == next_row]
+    print ("Importing data after row %d" % next_row)
+
+    if source is not None:
+        chunks = source.read_rows(endtime=endtime, first_row=next_row)
+    else:
+        chunks = tickfile.read_rows(args.datafile_path, endtime=endtime, first_row=next_row)
+
+    rowcount = 0
+    for time, price, amount, chunk_end in chunks:
+        for run_checkpoint in group:
+            run_checkpoint.extend(time, price, chunk_end)
+        rowcount += len(time)
+        print("Row: %s" % rowcount)
+
+print ('Data read')
+print ("\n")
+
+analytics = {}
+for run_name, run_checkpoint in checkpoints.items():
+    run_checkpoint.resume()
+    analytics[run_name] = run_checkpoint.analytics
+    print ("")
+
+    # Description of run, same as backtest.py makes
+    settings = run_checkpoint.settings
+    timeperiod_str = "%s - %s" % (dt.datetime.fromtimestamp(settings['starttime']),
+                                  dt.datetime.fromtimestamp(min(run_checkpoint.last_time, endtime)))
+    analytics[run_name].info = {'period': timeperiod_str, 'threshold_buy': settings['threshold_buy'], 'threshold_sell': settings['threshold_sell']}
+
+    print ("Saving %s checkpoint" % run_name)
+    run_checkpoint.save(paths[run_name])
+
+    if args.save_ledger:
+        print ("Saving %s trades ledger" % run_name)
+        analytics[run_name].save_ledger('ledger-%s %s.npz' % (run_name, timeperiod_str))
+
+    if args.save_results:
+        print ("Saving %s results" % run_name)
+        analytics[run_name].save('results-%s %s.npz' % (run_name, timeperiod_str))
+
+del checkpoints
+
+if args.do_plot:
+    report.plot_profit(list(analytics.values()))
+else:
+    print ("Plotting skipped")
+
+# Print stats to file
+for an_obj in analytics.values():
+    report.write_stats(an_obj)
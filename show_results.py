@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+
+import argparse
+
+# Own package imports
+from analysis.analysis import *
+from analysis import report
+
+"""
+
+Script to draw plots and write stats of results
+saved by backtest.py --save-results, without running backtest again
+
+"""
+
+aparser = argparse.ArgumentParser()
+aparser.add_argument('-r', '--results', dest='results_paths', nargs='+', required=True, help='Results .npz files. Plots of all files use one color scale')
+aparser.add_argument('--no-plot', dest='do_plot', action='store_false', help='Do not draw plots')
+aparser.add_argument('--no-stats', dest='do_stats', action='store_false', help='Do not write stats files')
+aparser.set_defaults(do_plot=True, do_stats=True)
+args = aparser.parse_args()
+
+analytics = []
+for path in args.results_paths:
+    print ("Loading %s" % path)
+    analytics.append(AveragesAnalytics.load(path))
+
+if args.do_plot:
+    report.plot_profit(analytics)
+
+if args.do_stats:
+    for an_obj in analytics:
+        report.write_stats(an_obj)
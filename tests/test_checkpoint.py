@@ -0,0 +1,87 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """[backtest]
+resolutions = 1h,2h
+average_periods = 1-10
+"""
+
+
+# Run script of the package in directory, output is not shown
+def run(directory, script, *args):
+    subprocess.check_call([sys.executable, os.path.join(ROOT, script)] + list(args), cwd=directory,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def write_ticks(path, time, price, mode='w'):
+    with open(path, mode) as f:
+        for values in zip(time, price):
+            f.write("%d,%.6f,1.0\n" % values)
+
+
+class ResumeTest(unittest.TestCase):
+    """ Resumed run has the same data and results as backtest of all data """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, 'ticks.csv')
+
+        rng = np.random.RandomState(1)
+        time = 1400000000 + np.cumsum(rng.randint(1, 120, 20000))
+        price = 500 + np.cumsum(rng.normal(0, 1, 20000))
+        write_ticks(self.csv_path, time, price)
+        self.last_time = int(time[-1])
+
+        for name in ('resumed', 'full'):
+            os.makedirs(os.path.join(self.directory, name))
+            with open(os.path.join(self.directory, name, 'config.ini'), 'w') as f:
+                f.write(CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_resume(self, time, price):
+        """ Append ticks between checkpoint and resume, compare with full backtest """
+        resumed = os.path.join(self.directory, 'resumed')
+        full = os.path.join(self.directory, 'full')
+
+        run(resumed, 'backtest.py', '-i', self.csv_path, '--no-plot', '--no-cache', '--checkpoint', 'cp')
+        write_ticks(self.csv_path, time, price, 'a')
+        run(resumed, 'resume_backtest.py', '-i', self.csv_path, '-c', 'cp', '--no-plot')
+        run(full, 'backtest.py', '-i', self.csv_path, '--no-plot', '--no-cache', '--checkpoint', 'cp')
+
+        stats = sorted(name for name in os.listdir(full) if name.startswith('stats-'))
+        self.assertEqual(len(stats), 2)
+        for name in stats:
+            with open(os.path.join(resumed, name)) as resumed_file, open(os.path.join(full, name)) as full_file:
+                self.assertEqual(resumed_file.read(), full_file.read())
+
+        for name in ('1h.npz', '2h.npz'):
+            with np.load(os.path.join(resumed, 'cp', name)) as resumed_cp, np.load(os.path.join(full, 'cp', name)) as full_cp:
+                for key in full_cp.files:
+                    # Number of appends counts segments of derived resolutions, only its being 0 matters
+                    if key == 'interval_append_tries':
+                        self.assertEqual(resumed_cp[key] > 0, full_cp[key] > 0)
+                    elif key.startswith('data_') or key.startswith('interval_') or key in ('results', 'next_row', 'last_time'):
+                        # Bytes, so that NaN of untested pairs are equal too
+                        self.assertEqual(resumed_cp[key].tobytes(), full_cp[key].tobytes(), key)
+
+    def test_same_second(self):
+        """ Trade appended at the last second of checkpoint """
+        self.check_resume([self.last_time], [1000.])
+
+    def test_late_tick(self):
+        """ Trades older than checkpoint appended among new ones """
+        self.check_resume([self.last_time, self.last_time - 600, self.last_time + 4000],
+                          [1000., 1., 600.])
+
+
+if __name__ == '__main__':
+    unittest.main()
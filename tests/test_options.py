@@ -0,0 +1,70 @@
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """[backtest]
+resolutions = 1h
+average_periods = 1-20
+"""
+
+
+class OptionsTest(unittest.TestCase):
+    """ Modes replacing backtest are not combined and take only options they use """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, 'ticks.csv')
+
+        rng = np.random.RandomState(2)
+        time = 1400000000 + np.cumsum(rng.randint(1, 120, 20000))
+        price = 500 + np.cumsum(rng.normal(0, 1, 20000))
+        with open(self.csv_path, 'w') as f:
+            for values in zip(time, price):
+                f.write("%d,%.6f,1.0\n" % values)
+        with open(os.path.join(self.directory, 'config.ini'), 'w') as f:
+            f.write(CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def backtest(self, *args):
+        """ Returns exit code and output of backtest.py """
+        process = subprocess.run([sys.executable, os.path.join(ROOT, 'backtest.py'), '-i', self.csv_path,
+                                  '--no-plot', '--no-cache'] + list(args),
+                                 cwd=self.directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return (process.returncode, process.stdout.decode())
+
+    def test_rejected(self):
+        for args in (('--search', '--sweep', '-a', '3'),
+                     ('--walk-forward', '2d', '1d', '--search'),
+                     ('--search', '-j', '2'),
+                     ('--search', '--checkpoint', 'cp'),
+                     ('--sweep', '-a', '3', '--ledger'),
+                     ('--walk-forward', '2d', '1d', '--save-results'),
+                     ('--search-eta', '2')):
+            code, output = self.backtest(*args)
+            self.assertEqual(code, 1, args)
+            self.assertIn('Error:', output, args)
+
+    def test_search_pairs(self):
+        """ Search takes only pairs given by --pairs """
+        given = set([(2, 5), (3, 17), (8, 12), (10, 19)])
+        code, output = self.backtest('--search', '--save-results', '--pairs', ','.join('%d:%d' % pair for pair in given))
+        self.assertEqual(code, 0, output)
+
+        results_path, = glob.glob(os.path.join(self.directory, 'results-1h *.npz'))
+        with np.load(results_path) as saved:
+            tested = set(tuple(pair) for pair in saved['pairs'].tolist())
+        self.assertTrue(tested)
+        self.assertTrue(tested <= given, tested)
+
+
+if __name__ == '__main__':
+    unittest.main()